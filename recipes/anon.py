@@ -7,14 +7,13 @@ AnonFiles 的优点：
 1.免费 2.容量大 3.保存时间长 4.国内可直接访问 5.有API 6.匿名
 
 https://github.com/ahui2016/ffe/raw/main/recipes/anon.py
-version: 2022-01-20
-# ffe >= v0.1.0
+version: 2026-10-19
+# ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
 import tomli
-import requests
 import pyperclip
 from ffe.model import (
     Recipe,
@@ -24,8 +23,9 @@ from ffe.model import (
     get_bool,
     must_files,
     names_limit,
+    throttled,
 )
-from ffe.util import app_config_file, get_proxies
+from ffe.util import app_config_file, get_proxies, get_session
 
 
 # 每个插件都必须继承 model.py 里的 Recipe
@@ -52,8 +52,8 @@ use_pipe = true   # 是否接受上一个任务的结果
 # 不设置 key 也可使用，如果注册了 AnonFiles 并且设置了 key, 可登入 AnonFiles 的账号查看已上传文件的列表。
 # 也可在 ffe-config.toml 里设置 key (参考 https://github.com/ahui2016/ffe/blob/main/examples/ffe-config.toml)
 # 你的 ffe-config.toml 文件位置可以用命令 `ffe info -cfg` 查看。
-# version: 2022-01-20
-# ffe >= v0.1.0
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
     @property  # 必须设为 @property
@@ -110,7 +110,10 @@ use_pipe = true   # 是否接受上一个任务的结果
             url += f"?token={self.key}"
         with open(self.filename, "rb") as f:
             print(f"uploading {self.filename} ......")
-            resp = requests.post(url, files={"file": f}, proxies=get_proxies())
+            # 如果在 ffe-config.toml 里设置了 [throttle] net_up, 则按设置限速。
+            resp = get_session().post(
+                url, files={"file": throttled(f, "net_up")}, proxies=get_proxies()
+            )
 
         resp.raise_for_status()
         result = resp.json()
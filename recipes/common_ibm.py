@@ -3,12 +3,12 @@
 本文件提供 ibm-upload 与 ibm-delete 的通用常量、函数。
 """
 
-from typing import TypedDict
+from typing import Callable, TypedDict
 import json
 import tomli
 import ibm_boto3
 from ibm_botocore.client import Config, ClientError
-from ffe.model import MB
+from ffe.model import MB, throttled
 from ffe.util import app_config_file
 
 
@@ -60,7 +60,15 @@ def get_ibm_client(cfg_ibm: dict, proxies: dict | None):
 
 
 # https://cloud.ibm.com/docs/cloud-object-storage?topic=cloud-object-storage-python#python-examples-multipart
-def upload(cos, bucket_name: str, item_name: str, size_limit: int, file_path: str):
+def upload(
+    cos,
+    bucket_name: str,
+    item_name: str,
+    size_limit: int,
+    file_path: str,
+    callback: Callable[[int], None] | None = None,
+):
+    """callback 会在上传过程中不断被调用，参数是新上传的字节数 (可能在多个线程中调用)。"""
     try:
         # set the transfer threshold and chunk size
         transfer_config = ibm_boto3.s3.transfer.TransferConfig(
@@ -69,9 +77,12 @@ def upload(cos, bucket_name: str, item_name: str, size_limit: int, file_path: st
 
         # the upload_fileobj method will automatically execute a multi-part upload
         # in 5 MB chunks for all files over 15 MB
+        # 如果在 ffe-config.toml 里设置了 [throttle] net_up, 则按设置限速。
         with open(file_path, "rb") as file_data:
             cos.Object(bucket_name, item_name).upload_fileobj(
-                Fileobj=file_data, Config=transfer_config
+                Fileobj=throttled(file_data, "net_up"),
+                Config=transfer_config,
+                Callback=callback,
             )
 
         print("Transfer complete.")
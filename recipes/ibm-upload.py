@@ -8,8 +8,8 @@ IBM COS 的优点：
 
 https://github.com/ahui2016/ffe/raw/main/recipes/common_ibm.py
 https://github.com/ahui2016/ffe/raw/main/recipes/ibm-upload.py
-version: 2022-01-28
-ffe >= v0.1.0
+version: 2026-10-19
+ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
@@ -27,6 +27,7 @@ from ffe.model import (
     must_exist,
     must_files,
     names_limit,
+    get_reporter,
     MB,
 )
 from ffe.util import get_proxies
@@ -66,8 +67,8 @@ use_pipe = true    # 是否接受上一个任务的结果
 # - 启用 IBM Cloud Object Storage 并且创建一个 bucket https://cloud.ibm.com/objectstorage/create
 # - 收集必要参数 https://cloud.ibm.com/docs/cloud-object-storage?topic=cloud-object-storage-python#python-prereqs
 # - 把相关信息填写到 ffe-config.toml (参考 https://github.com/ahui2016/ffe/blob/main/examples/ffe-config.toml)
-# version: 2022-01-28
-# ffe >= v0.1.0
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
     @property  # 必须设为 @property
@@ -143,7 +144,16 @@ use_pipe = true    # 是否接受上一个任务的结果
         cfg_ibm = get_config()
         cos = get_ibm_resource(cfg_ibm, get_proxies())
         bucket_name = cfg_ibm["bucket_name"]
-        upload(cos, bucket_name, self.item_name, self.size_limit, self.filename)
+        reporter = get_reporter()
+        reporter.set_total(Path(self.filename).lstat().st_size)
+        upload(
+            cos,
+            bucket_name,
+            self.item_name,
+            self.size_limit,
+            self.filename,
+            callback=reporter.add_bytes,
+        )
 
         # 更新计数器
         print(f"Update files counter...")
@@ -7,23 +7,30 @@ dependencies = ["cryptography"]
 缺点：保密性不高；优点：非常方便，不需要密码。
 
 https://github.com/ahui2016/ffe/raw/main/recipes/mimi.py
-# version: 2022-01-20
-# ffe >= v0.1.0
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
-from cryptography.fernet import Fernet
+import os
+import base64
+import struct
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from pathlib import Path
 from enum import Enum, auto
+from typing import IO, Iterator
 from ffe.model import (
     Recipe,
     ErrMsg,
     Result,
+    MB,
     get_bool,
     must_exist,
-    must_files,
     names_limit,
+    process_pool,
 )
 
 
@@ -31,6 +38,22 @@ len_of_key = 43
 len_of_head = 15
 default_suffix = ".mimi"
 
+# 第 2 版格式 (流式，分块加密):
+#   header: magic "MIMI" + 版本号 (1 字节) + 加密方法 (1 字节) + 分块大小 (4 字节) + key
+#   之后是一个个数据块: 长度 (4 字节) + 密文
+# 每块都绑定块序号与是否最后一块的标记，防止数据块被调换顺序或截断:
+# fernet 把它们加在明文前面; aesgcm, chacha20 则用作 nonce, 并以 header 作为附加验证数据。
+# 旧版格式 (整个文件一个 Fernet token, key 混在其中) 以 "gAAAAA" 开头，解密时自动识别。
+magic = b"MIMI"
+format_version = 2
+header_format = ">4sBBI"
+chunk_format = ">QB"  # 块序号, 是否最后一块
+chunk_size = 1 * MB
+cipher_ids = {"fernet": 1, "aesgcm": 2, "chacha20": 3}
+len_of_raw_key = 32
+record_overhead = 128
+"""每块密文比明文多出的字节数上限 (fernet 约 82 字节, aesgcm 与 chacha20 为 16 字节)"""
+
 
 class Method(Enum):
     Encrypt = auto()
@@ -48,20 +71,26 @@ class Mimi(Recipe):
         return """
 [[tasks]]
 recipe = "mimi"     # 秘密：加密/解密
-names = [           # 每次只能处理一个文件
+names = [           # 可以是多个文件或文件夹 (文件夹内的全部文件都会被处理)
   'plain.txt.mimi'  # 后缀名 '.mimi' 表示需要解密，否则表示需要加密
-]
+]                   # 可以解密旧版 (ffe v0.1) 加密的文件
 
 [tasks.options]
 suffix = ".mimi"   # 已加密文件的后缀名(如果省略，则默认为 '.mimi')
 overwrite = false  # 如果文件名已存在，是否允许覆盖文件
+cipher = "fernet"  # 加密方法: fernet / aesgcm / chacha20 (解密时自动识别)
+threads = 0        # 处理多个文件时使用多少个进程，设为 0 则使用全部 CPU 核心
 use_pipe = true    # 是否接受上一个任务的结果
 
 # 本插件加密时把随机生成的 key 混在加密后的数据里，因此加密、解密都不需要输入密码，
 # 但只适用于保密要求不高的情况，比如发送文件给同事、朋友，或暂时保存文件到网盘等，
 # 用于避免传输过程泄密或被服务商扫描，对于保密要求不高的情况已经够用了。
-# version: 2022-01-20
-# ffe >= v0.1.0
+# 加密/解密时每次只读取 1 MB, 因此处理大文件也不会占用大量内存。
+# aesgcm (在支持 AES-NI 的 CPU 上) 与 chacha20 比 fernet 快得多。
+# 每个文件根据各自的后缀名决定加密或解密，开始处理前先检查全部输出文件是否已存在，
+# 个别文件处理失败时，其他文件照常处理，最后汇总报告错误。
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
     @property  # 必须设为 @property
@@ -69,16 +98,18 @@ use_pipe = true    # 是否接受上一个任务的结果
         return dict(
             suffix=default_suffix,
             overwrite=False,
+            cipher="fernet",
+            threads=0,
             use_pipe=False,
         )
 
     def validate(self, names: list[str], options: dict) -> ErrMsg:
         """初步检查参数（比如文件数量与是否存在），并初始化以下项目：
 
-        - self.method
-        - self.plain_file
-        - self.cipher_file
+        - self.jobs (每个文件的加密/解密方法、输入文件、输出文件)
         - self.overwrite
+        - self.cipher
+        - self.threads
         """
         # 要在 dry_run, exec 中确认 is_validated
         self.is_validated = True
@@ -87,6 +118,16 @@ use_pipe = true    # 是否接受上一个任务的结果
         if err:
             return err
 
+        self.cipher = options.get("cipher", "fernet")
+        if self.cipher not in cipher_ids:
+            return f'"cipher" should be one of {", ".join(cipher_ids)}'
+
+        self.threads = options.get("threads", 0)
+        if not isinstance(self.threads, int) or self.threads < 0:
+            return '"threads" should be 0 or larger'
+        if self.threads == 0:
+            self.threads = os.cpu_count() or 1
+
         self.suffix = options.get("suffix", "")
         if not self.suffix:
             self.suffix = default_suffix
@@ -96,39 +137,36 @@ use_pipe = true    # 是否接受上一个任务的结果
         if options_names:
             names = options_names
 
-        names, err = names_limit(names, 1, 1)
+        names, err = names_limit(names, 1)
+        if err:
+            return err
+        err = must_exist(names)
         if err:
             return err
-        filepath = Path(names[0])
-        if filepath.suffix == self.suffix:
-            self.method = Method.Decrypt
-            self.cipher_file = filepath
-            self.plain_file = filepath.with_suffix("")
-        else:
-            self.method = Method.Encrypt
-            self.plain_file = filepath
-            suffix = filepath.suffix + self.suffix
-            self.cipher_file = filepath.with_suffix(suffix)
 
-        match self.method:
-            case Method.Encrypt:
-                err = must_exist([self.plain_file])
-                if err:
-                    return err
-                err = must_files([self.plain_file])
-                if err:
-                    return err
-                if (not self.overwrite) and self.cipher_file.exists():
-                    return f"Already Exists: {self.cipher_file}"
-            case Method.Decrypt:
-                err = must_exist([self.cipher_file])
-                if err:
-                    return err
-                err = must_files([self.cipher_file])
-                if err:
-                    return err
-                if (not self.overwrite) and self.plain_file.exists():
-                    return f"Already Exists: {self.plain_file}"
+        self.jobs: list[tuple[Method, Path, Path]] = []
+        for file in list_files(names):
+            if file.suffix == self.suffix:
+                self.jobs.append((Method.Decrypt, file, file.with_suffix("")))
+            else:
+                cipher_file = file.with_suffix(file.suffix + self.suffix)
+                self.jobs.append((Method.Encrypt, file, cipher_file))
+        if not self.jobs:
+            return f"No file in: {', '.join(names)}"
+
+        # 在开始处理之前检查全部输出文件
+        outputs = [dst for _, _, dst in self.jobs]
+        if len(set(outputs)) < len(outputs):
+            return "Different files have the same output name"
+        # 同一个文件不可既被读取又被写入 (比如同时有 a.txt 与 a.txt.mimi)
+        sources = {src.resolve() for _, src, _ in self.jobs}
+        conflicts = [str(dst) for dst in outputs if dst.resolve() in sources]
+        if conflicts:
+            return "Output files are also input files:\n" + "\n".join(conflicts)
+        if not self.overwrite:
+            exists = [str(dst) for dst in outputs if dst.exists()]
+            if exists:
+                return "Already Exists:\n" + "\n".join(exists)
         return ""
 
     def dry_run(self) -> Result:
@@ -137,41 +175,199 @@ use_pipe = true    # 是否接受上一个任务的结果
         if self.overwrite:
             print("overwrite: True")
 
-        result: list[str] = []
-        match self.method:
-            case Method.Encrypt:
-                print(f"'{self.plain_file}' is encrypted to '{self.cipher_file}'")
-                result.append(self.cipher_file.name)
-            case Method.Decrypt:
-                print(f"'{self.cipher_file}' is decrypted to '{self.plain_file}'")
-                result.append(self.plain_file.name)
-        return result, ""
+        for method, src, dst in self.jobs:
+            match method:
+                case Method.Encrypt:
+                    print(f"'{src}' is encrypted to '{dst}'")
+                case Method.Decrypt:
+                    print(f"'{src}' is decrypted to '{dst}'")
+        return [str(dst) for _, _, dst in self.jobs], ""
 
     def exec(self) -> Result:
         assert self.is_validated, "在执行 exec 之前必须先执行 validate"
-        match self.method:
-            case Method.Encrypt:
+        result, _ = self.dry_run()
+        args = [(method, src, dst, self.cipher) for method, src, dst in self.jobs]
+        if len(args) == 1 or self.threads == 1:
+            errors = [process_file(*x) for x in args]
+        else:
+            with process_pool(min(self.threads, len(args))) as pool:
+                errors = list(pool.map(process_file, *zip(*args)))
+
+        failed = [err for err in errors if err]
+        if failed:
+            done = [x for x, err in zip(result, errors) if not err]
+            err = f"{len(failed)} of {len(errors)} files failed:\n" + "\n".join(failed)
+            return done, err
+        return result, ""
+
+
+__recipe__ = Mimi
+
+
+class ChunkCipher:
+    """用同一个 key 逐块加密/解密，每块都绑定块序号与是否最后一块。"""
+
+    def __init__(self, cipher: str, key: bytes, header: bytes) -> None:
+        self.cipher = cipher
+        self.header = header
+        match cipher:
+            case "fernet":
                 # https://cryptography.io/en/latest/fernet/
-                key = Fernet.generate_key()
-                with open(self.plain_file, "rb") as data, open(
-                    self.cipher_file, "wb"
-                ) as cipher_file:
-                    token = Fernet(key).encrypt(data.read())
-                    head, tail = token[:len_of_head], token[len_of_head:]
-                    cipher_file.write(head + key[:-1] + tail)
+                self.fernet = Fernet(base64.urlsafe_b64encode(key))
+            case "aesgcm":
+                self.aead = AESGCM(key)
+            case "chacha20":
+                self.aead = ChaCha20Poly1305(key)
+
+    @staticmethod
+    def nonce(index: int, final: bool) -> bytes:
+        """96 位 nonce: 块序号 (8 字节) + 3 个零字节 + 是否最后一块 (1 字节)。
+        每个文件的 key 都是随机生成的，因此 nonce 不会重复。
+        """
+        return struct.pack(">Q3xB", index, final)
+
+    def encrypt(self, index: int, final: bool, chunk: bytes) -> bytes:
+        if self.cipher == "fernet":
+            plain = struct.pack(chunk_format, index, final) + chunk
+            return base64.urlsafe_b64decode(self.fernet.encrypt(plain))
+        return self.aead.encrypt(self.nonce(index, final), chunk, self.header)
+
+    def decrypt(self, index: int, final: bool, record: bytes) -> bytes:
+        if self.cipher == "fernet":
+            plain = self.fernet.decrypt(base64.urlsafe_b64encode(record))
+            prefix = struct.calcsize(chunk_format)
+            if struct.unpack(chunk_format, plain[:prefix]) != (index, final):
+                raise ValueError("chunks out of order or truncated")
+            return plain[prefix:]
+        return self.aead.decrypt(self.nonce(index, final), record, self.header)
+
+
+def list_files(names: list[str]) -> list[Path]:
+    """names 中的文件以及文件夹内的全部文件 (递归)。"""
+    files: list[Path] = []
+    for name in names:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(x for x in sorted(path.rglob("*")) if x.is_file())
+        else:
+            files.append(path)
+    return files
+
+
+def process_file(method: Method, src: Path, dst: Path, cipher: str) -> ErrMsg:
+    """加密或解密一个文件 (处理多个文件时在子进程中执行)，出错时返回错误信息。"""
+    try:
+        match method:
+            case Method.Encrypt:
+                encrypt_file(src, dst, cipher)
             case Method.Decrypt:
-                with open(self.cipher_file, "rb") as blob, open(
-                    self.plain_file, "wb"
-                ) as plain_file:
-                    blob_bytes = blob.read()
-                    head, key, tail = (
-                        blob_bytes[:len_of_head],
-                        blob_bytes[len_of_head : len_of_head + len_of_key] + b"=",
-                        blob_bytes[len_of_head + len_of_key :],
-                    )
-                    plain_data = Fernet(key).decrypt(head + tail)
-                    plain_file.write(plain_data)
-        return self.dry_run()
+                return decrypt_file(src, dst)
+    except OSError as e:
+        dst.unlink(missing_ok=True)
+        return f"{src}: {e}"
+    return ""
 
 
-__recipe__ = Mimi
+def encrypt_file(plain_file: Path, cipher_file: Path, cipher: str = "fernet") -> None:
+    """以第 2 版格式加密 (每次读取 chunk_size 的数据加密后写入)。"""
+    key = AESGCM.generate_key(bit_length=len_of_raw_key * 8)
+    header = struct.pack(
+        header_format, magic, format_version, cipher_ids[cipher], chunk_size
+    )
+    chunks = ChunkCipher(cipher, key, header)
+    with open(plain_file, "rb") as data, open(cipher_file, "wb") as out:
+        out.write(header + key)
+        for index, (chunk, final) in enumerate(read_chunks(data, chunk_size)):
+            record = chunks.encrypt(index, final, chunk)
+            out.write(struct.pack(">I", len(record)) + record)
+
+
+def read_chunks(f: IO[bytes], size: int) -> Iterator[tuple[bytes, bool]]:
+    """每次读取 size 的数据，同时返回是否最后一块 (空文件也返回一块空数据)。"""
+    chunk = f.read(size)
+    while True:
+        following = f.read(size)
+        yield chunk, not following
+        if not following:
+            return
+        chunk = following
+
+
+def read_records(f: IO[bytes], max_length: int) -> Iterator[tuple[bytes, bool]]:
+    """逐个读取密文数据块，同时返回是否最后一块。
+
+    长度超过 max_length 的数据块视为文件已损坏，不读取 (以免读入过多数据)。
+    """
+
+    def read_one() -> bytes | None:
+        head = f.read(4)
+        if not head:
+            return None
+        if len(head) < 4:
+            raise ValueError("truncated")
+        (length,) = struct.unpack(">I", head)
+        if length > max_length:
+            raise ValueError("record too large")
+        record = f.read(length)
+        if len(record) < length:
+            raise ValueError("truncated")
+        return record
+
+    record = read_one()
+    while record is not None:
+        following = read_one()
+        yield record, following is None
+        record = following
+
+
+def decrypt_file(cipher_file: Path, plain_file: Path) -> ErrMsg:
+    """自动识别第 2 版格式或旧版格式。
+
+    先解密到同一文件夹内的临时文件，全部数据块都验证成功后才替换 plain_file,
+    因此解密失败时不会破坏已存在的 plain_file.
+    """
+    temp = plain_file.with_name(f".{plain_file.name}.{os.getpid()}.tmp")
+    try:
+        with open(cipher_file, "rb") as f:
+            is_v2 = f.read(len(magic)) == magic
+        if is_v2:
+            err = decrypt_v2(cipher_file, temp)
+        else:
+            err = decrypt_legacy(cipher_file, temp)
+        if not err:
+            os.replace(temp, plain_file)
+    except (InvalidToken, InvalidTag, ValueError, struct.error):
+        err = f"Failed to decrypt '{cipher_file}' (文件已损坏或不是 mimi 格式)"
+    finally:
+        temp.unlink(missing_ok=True)
+    return err
+
+
+def decrypt_v2(cipher_file: Path, plain_file: Path) -> ErrMsg:
+    with open(cipher_file, "rb") as blob, open(plain_file, "wb") as out:
+        header = blob.read(struct.calcsize(header_format))
+        _, version, cipher_id, _ = struct.unpack(header_format, header)
+        if version != format_version:
+            return f"Unknown mimi version {version}: '{cipher_file}'"
+        ciphers = {v: k for k, v in cipher_ids.items()}
+        if cipher_id not in ciphers:
+            return f"Unknown cipher {cipher_id}: '{cipher_file}'"
+        chunks = ChunkCipher(ciphers[cipher_id], blob.read(len_of_raw_key), header)
+        for index, (record, final) in enumerate(
+            read_records(blob, chunk_size + record_overhead)
+        ):
+            out.write(chunks.decrypt(index, final, record))
+    return ""
+
+
+def decrypt_legacy(cipher_file: Path, plain_file: Path) -> ErrMsg:
+    """旧版格式 (ffe v0.1): 整个文件是一个 Fernet token, key 混在第 len_of_head 个字节之后。"""
+    with open(cipher_file, "rb") as blob, open(plain_file, "wb") as plain:
+        blob_bytes = blob.read()
+        head, key, tail = (
+            blob_bytes[:len_of_head],
+            blob_bytes[len_of_head : len_of_head + len_of_key] + b"=",
+            blob_bytes[len_of_head + len_of_key :],
+        )
+        plain.write(Fernet(key).decrypt(head + tail))
+    return ""
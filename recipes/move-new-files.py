@@ -1,25 +1,31 @@
 """move-new-files: 移动 n 个指定后缀的新文件。
 dependencies = ["humanfriendly"]
 
-只能用来移动一个文件夹内的第一层文件，不能移动文件夹，也不会递归处理子文件夹。
+只能用来移动文件，不能移动文件夹。默认只处理源头文件夹内的第一层文件，
+设置 recursive 则包括子文件夹内的文件 (全部移动到目标文件夹的第一层)。
 
 本插件用来移动新文件，通过 st_mtime 来对文件排序。
     st_mtime:
         time of most recent content modification
 
-使用 shutil.move 来移动文件，因此会先尝试改名，改名失败再进行复制和删除操作。
+移动文件时会先尝试改名，改名失败 (跨分区) 再进行复制和删除操作，
+复制时使用 ffe 的 copy_files (reflink / 内核复制，同时复制多个文件)。
 
 https://github.com/ahui2016/ffe/raw/main/recipes/move-new-files.py
-version: 2022-01-20
-# ffe >= v0.1.0
+version: 2026-10-19
+# ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
 from sys import prefix
 from humanfriendly import format_size
+import os
+import json
+import heapq
 import shutil
 from pathlib import Path
+from typing import Iterator
 from ffe.model import (
     Recipe,
     ErrMsg,
@@ -28,7 +34,17 @@ from ffe.model import (
     get_bool,
     must_folders,
     names_limit,
+    copy_files,
+    verify_hashes,
 )
+from ffe.util import app_data_dir, write_atomic
+
+
+state_file = app_data_dir.joinpath("move-new-files.json")
+"""since_last_run 模式下记录每对 (源头文件夹, 目标文件夹) 的水位线"""
+
+manifest_names = {"blake2b": "B2SUMS", "sha256": "SHA256SUMS"}
+"""verify 时在目标文件夹内记录 hash 的文件 (格式与 b2sum, sha256sum 相同)"""
 
 
 # 每个插件都必须继承 model.py 里的 Recipe
@@ -53,11 +69,23 @@ suffix = ".jpg"    # 指定文件名的末尾，空字符串表示不限
 prefix = ""        # 指定文件名的开头，空字符串表示不限
 overwrite = false  # 是否覆盖同名文件
 copy_only = false  # 设为 true 则只是复制，不删除源头文件
+since_last_run = false  # 只处理上次运行之后出现的文件
+recursive = false  # 是否包括子文件夹内的文件 (全部移动到目标文件夹的第一层)
+verify = ""        # 复制时同时计算 hash: blake2b / sha256, 空字符串表示不计算
+verify_dst = false  # 复制后是否重新读取目标文件核对 hash
 use_pipe = true    # 是否接受上一个任务的结果
 
-# 注意：本插件在设计上并未对移动大量文件的场景进行优化，建议只用来移动少量文件。
-# version: 2022-01-20
-# ffe >= v0.1.0
+# 源头文件夹内有大量文件也没关系 (只遍历一次，只保留最新的 n 个)。
+# 跨分区时会同时复制多个文件，全部完成后才结束，因此 n 不宜太大。
+# recursive 为 true 时，不同子文件夹内的同名文件只处理第一个，其余的作为错误报告。
+# since_last_run 为 true 时，记录已处理文件的最大修改时间 (水位线)，
+# 以后只处理比水位线新的文件，并且按从旧到新的顺序处理 n 个 (以免遗漏)。
+# 此时如果 recursive 也为 true, 修改时间没变的子文件夹不会再被读取，
+# 因此只能发现新增 (或移入) 的文件，不能发现原地修改的文件。
+# verify 不为空时，hash 记录在目标文件夹内的 B2SUMS 或 SHA256SUMS
+# (可用 b2sum -c 或 sha256sum -c 检查)，跨分区移动时复制并核对成功后才删除源头文件。
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
     @property  # 注意: 必须设为 @property
@@ -68,6 +96,10 @@ use_pipe = true    # 是否接受上一个任务的结果
             prefix="",
             overwrite=False,
             copy_only=False,
+            since_last_run=False,
+            recursive=False,
+            verify="",
+            verify_dst=False,
             use_pipe=False,
         )
 
@@ -81,6 +113,10 @@ use_pipe = true    # 是否接受上一个任务的结果
         - self.prefix
         - self.overwrite
         - self.copy_only
+        - self.since_last_run
+        - self.recursive
+        - self.verify
+        - self.verify_dst
         """
         # 要在 dry_run, exec 中确认 is_validated
         self.is_validated = True
@@ -105,7 +141,19 @@ use_pipe = true    # 是否接受上一个任务的结果
         self.suffix = options.get("suffix", "").strip().lower()
         self.prefix = options.get("prefix", "").strip().lower()
         self.overwrite, err = get_bool(options, "overwrite")
+        if err:
+            return err
         self.copy_only = options.get("copy_only", False)
+        self.since_last_run, err = get_bool(options, "since_last_run")
+        if err:
+            return err
+        self.recursive, err = get_bool(options, "recursive")
+        if err:
+            return err
+        self.verify = options.get("verify", "")
+        if self.verify and self.verify not in verify_hashes:
+            return f'"verify" should be one of {", ".join(verify_hashes)} or ""'
+        self.verify_dst, err = get_bool(options, "verify_dst")
         return err
 
     def dry_run(self, really_run: bool = False) -> Result:
@@ -123,9 +171,22 @@ use_pipe = true    # 是否接受上一个任务的结果
         if free_space <= files_size:
             return [], f"Not enough space in {self.target_dir}"
 
-        print_and_move(
-            Path(self.target_dir), src_files, self.overwrite, self.copy_only, really_run
+        pairs, errors = print_and_move(
+            Path(self.target_dir), src_files, self.overwrite, self.copy_only
+        )
+        if not really_run:
+            return [self.target_dir], "\n".join(errors)
+
+        digests, copy_errors = copy_files(
+            pairs, not self.copy_only, self.verify, self.verify_dst
         )
+        errors.extend(copy_errors)
+        if self.verify and digests:
+            update_manifest(Path(self.target_dir), self.verify, digests)
+        if errors:
+            return [], "\n".join(errors)
+        if self.since_last_run:
+            self.save_state()
         return [self.target_dir], ""
 
     def exec(self) -> Result:
@@ -133,45 +194,160 @@ use_pipe = true    # 是否接受上一个任务的结果
         return self.dry_run(really_run=True)
 
     def get_new_files(self) -> tuple[list[Path], int, int]:
-        src_files = Path(self.src_dir).glob("*")
-        src_files = [x for x in src_files if x.is_file()]
+        """遍历一次源头文件夹 (见 scan)，用堆保留最新的 n 个文件，
+        since_last_run 时则保留比水位线新的文件中最旧的 n 个。
+
+        时间复杂度 O(M log n), 内存 O(n), 其中 M 是源头文件夹内的文件数量。
+        """
         if self.suffix:
             print(f"suffix: {self.suffix}")
-            src_files = [
-                x for x in src_files if x.__str__().lower().endswith(self.suffix)
-            ]
-        if self.prefix:
-            src_files = [
-                x for x in src_files if x.name.__str__().lower().startswith(self.prefix)
-            ]
-
-        src_files.sort(key=lambda x: x.lstat().st_mtime, reverse=True)
-        src_files = src_files[: self.n]
-        files_size = sum([x.lstat().st_size for x in src_files])
+        self.state = load_state(self.src_dir, self.target_dir)
+        files = self.scan()
+        if self.since_last_run:
+            if self.state["mtime_ns"] >= 0:
+                print(f"since last run: {self.state['mtime_ns'] / 1e9:.3f}")
+            self.selected = heapq.nsmallest(self.n, files)
+        else:
+            self.selected = heapq.nlargest(self.n, files)
+
+        src_files = [Path(path) for _, path, _, _ in self.selected]
+        files_size = sum(size for _, _, size, _ in self.selected)
         free_space = shutil.disk_usage(self.target_dir).free
         return src_files, files_size, free_space
 
+    def scan(self) -> Iterator[tuple[int, str, int, int]]:
+        """用 os.scandir 遍历源头文件夹，先按文件名过滤，
+        返回 (st_mtime_ns, 路径, st_size, st_ino), 每个文件最多 stat 一次。
+
+        recursive 时包括子文件夹，并把每个子文件夹的修改时间与其中的子文件夹记录在 self.dirs,
+        每个文件夹返回了多少个文件记录在 self.pending;
+        since_last_run 时跳过不比水位线新的文件，并且不读取修改时间没变的子文件夹
+        (只进入上次记录的子文件夹)。
+        """
+        watermark = self.state["mtime_ns"] if self.since_last_run else -1
+        handled = set(self.state["inodes"]) if self.since_last_run else set()
+        old_dirs = self.state["dirs"] if self.since_last_run else {}
+        self.dirs: dict[str, list] = {}
+        self.pending: dict[str, int] = {}
+        stack = [self.src_dir]
+        while stack:
+            folder = stack.pop()
+            rel = os.path.relpath(folder, self.src_dir)
+            if self.recursive:
+                mtime = os.stat(folder).st_mtime_ns
+                prev = old_dirs.get(rel)
+                if folder != self.src_dir and prev and prev[0] == mtime:
+                    self.dirs[rel] = prev
+                    stack.extend(os.path.join(folder, x) for x in prev[1])
+                    continue
+            subdirs = []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if self.recursive and entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                        continue
+                    name = entry.name.lower()
+                    if self.suffix and not name.endswith(self.suffix):
+                        continue
+                    if self.prefix and not name.startswith(self.prefix):
+                        continue
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_mtime_ns < watermark or (
+                        st.st_mtime_ns == watermark and st.st_ino in handled
+                    ):
+                        continue
+                    self.pending[rel] = self.pending.get(rel, 0) + 1
+                    yield st.st_mtime_ns, entry.path, st.st_size, st.st_ino
+            if self.recursive:
+                self.dirs[rel] = [mtime, sorted(subdirs)]
+                stack.extend(os.path.join(folder, x) for x in subdirs)
+
+    def save_state(self) -> None:
+        """更新水位线: 已处理文件的最大修改时间，以及该修改时间的已处理文件的 inode."""
+        state = self.state
+        if self.selected:
+            newest = max(mtime for mtime, _, _, _ in self.selected)
+            if newest > state["mtime_ns"]:
+                state["mtime_ns"], state["inodes"] = newest, []
+            inodes = [ino for mtime, _, _, ino in self.selected if mtime == newest]
+            state["inodes"] = sorted(set(state["inodes"] + inodes))
+        if self.recursive:
+            # 还有文件未处理 (超出 n 个) 的文件夹，下次必须重新读取。
+            for _, path, _, _ in self.selected:
+                self.pending[os.path.relpath(os.path.dirname(path), self.src_dir)] -= 1
+            for rel, count in self.pending.items():
+                if count:
+                    self.dirs.pop(rel, None)
+            state["dirs"] = self.dirs
+        all_states = load_all_states()
+        all_states[state_key(self.src_dir, self.target_dir)] = state
+        app_data_dir.mkdir(parents=True, exist_ok=True)
+        write_atomic(state_file, json.dumps(all_states, indent=2).encode())
+
 
 __recipe__ = MoveNewFiles
 
 
+def state_key(src_dir: str, target_dir: str) -> str:
+    return f"{os.path.abspath(src_dir)} -> {os.path.abspath(target_dir)}"
+
+
+def load_all_states() -> dict[str, dict]:
+    try:
+        return json.loads(state_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def load_state(src_dir: str, target_dir: str) -> dict:
+    """读取 (src_dir, target_dir) 的水位线，没有则返回初始值。"""
+    state = load_all_states().get(state_key(src_dir, target_dir))
+    return state or dict(mtime_ns=-1, inodes=[], dirs={})
+
+
+def update_manifest(folder: Path, hash_name: str, digests: dict[Path, str]) -> None:
+    """把 hash 写入 folder 内的 B2SUMS 或 SHA256SUMS (同名文件的旧记录会被替换)。"""
+    file = folder.joinpath(manifest_names[hash_name])
+    entries: dict[str, str] = {}
+    if file.exists():
+        for line in file.read_text(encoding="utf-8").splitlines():
+            digest, _, name = line.partition("  ")
+            if name:
+                entries[name] = digest
+    for dst, digest in digests.items():
+        entries[dst.name] = digest
+    lines = "".join(f"{digest}  {name}\n" for name, digest in entries.items())
+    write_atomic(file, lines.encode("utf-8"))
+
+
 def print_and_move(
     dst_folder: Path,
     src_files: list[Path],
     overwrite: bool,
     copy_only: bool,
-    really_run: bool = False,
-) -> None:
-
+) -> tuple[list[tuple[Path, Path]], list[ErrMsg]]:
+    """打印每个文件将如何处理，返回需要复制/移动的 (src, dst) 列表。
+
+    不同子文件夹内的同名文件 (recursive) 只处理第一个，其余的作为错误返回。
+    """
+    pairs: list[tuple[Path, Path]] = []
+    errors: list[ErrMsg] = []
+    planned: set[Path] = set()
     for src in src_files:
         dst = dst_folder.joinpath(src.name)
+        if dst in planned:
+            print(f"-- skip {src} (same name as another file)")
+            errors.append(f"Duplicate name, not moved: {src}")
+            continue
+        planned.add(dst)
         dst_exists = dst.exists()
 
         # 优先、重点处理覆盖文件的情形。
         if dst_exists and overwrite:
             print(f"-- overwrite {dst}")
-            if really_run:
-                copy_or_move(src, dst, copy_only)
+            pairs.append((src, dst))
             continue
 
         # 不覆盖文件。
@@ -182,12 +358,5 @@ def print_and_move(
         # 此时 dst 必然不存在，正常移动文件即可。
         verb = "copy to" if copy_only else "move to"
         print(f"-- {verb} {dst}")
-        if really_run:
-            copy_or_move(src, dst, copy_only)
-
-
-def copy_or_move(src: Path, dst: Path, copy_only: bool) -> None:
-    if copy_only:
-        shutil.copyfile(src, dst)
-    else:
-        shutil.move(src, dst)
+        pairs.append((src, dst))
+    return pairs, errors
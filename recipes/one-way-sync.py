@@ -2,11 +2,53 @@
 
 可选择按日期 及/或 按内容对比文件。
 新增(add), 更新(update), 删除(delete) 三种情况均可单独控制。
+
+同时遍历源头文件夹与目标文件夹 (每个子文件夹各 scandir 一次，按文件名排序后合并对比)，
+因此内存占用只与单个文件夹的大小及目录深度有关，可处理上百万个文件。
+复制文件时使用 ffe 的 copy_files (reflink / 内核复制，同时复制多个文件)。
+按内容对比时使用 ffe 的 hash 缓存，没有变化的文件不需要重新读取。
+
+https://github.com/ahui2016/ffe/raw/main/recipes/one-way-sync.py
+version: 2026-10-19
+# ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
-from ffe.model import Recipe, ErrMsg, must_exist, names_limit
+import os
+import shutil
+import sqlite3
+import fnmatch
+from pathlib import Path
+from typing import Iterator
+from ffe.model import (
+    MB,
+    Recipe,
+    ErrMsg,
+    Result,
+    HashCache,
+    copy_files,
+    hash_files,
+    get_bool,
+    get_reporter,
+    must_folders,
+    names_limit,
+)
+
+Action = tuple[str, str, int]
+"""(操作, 相对路径, 文件体积), 操作是 mkdir / add / update / delete / rmtree 之一"""
+
+mtime_tolerance_ns = 1_000_000_000
+"""修改时间相差不到 1 秒视为相同 (有些文件系统只精确到秒)"""
+
+batch_size = 256
+"""每累积多少个需要复制的文件就交给 copy_files 同时复制一批"""
+
+check_batch = 1024
+"""每累积多少对需要对比内容的文件就一起计算 hash"""
+
+errors_limit = 20
+"""最多显示多少条错误信息"""
 
 
 # 每个插件都必须继承 model.py 里的 Recipe
@@ -17,7 +59,35 @@ class OneWaySync(Recipe):
 
     @property  # 必须设为 @property
     def help(self) -> str:
-        return "coming soon... (本插件正在施工中)"
+        return """
+[[tasks]]
+recipe = "one-way-sync"  # 单向同步: 使目标文件夹与源头文件夹一致
+names = [                # names 必须是（不多不少）两个文件夹
+    'target_dir',        # 第一个是目标文件夹
+    'src_dir',           # 第二个是源头文件夹
+]
+
+[tasks.options]
+add = true          # 复制源头有、目标没有的文件
+update = true       # 覆盖两边都有但内容不同的文件
+delete = false      # 删除目标有、源头没有的文件 (及文件夹)
+by_date = false     # 对比修改时间
+by_content = true   # 对比文件内容
+ignore = []         # 忽略的文件名 (及文件夹名), 可使用通配符，如 ['*.tmp', '.git']
+verbose = true      # 是否逐个显示每个文件的操作
+use_pipe = true     # 是否接受上一个任务的结果
+
+# 先对比文件体积，体积不同则需要更新，体积相同时:
+# - by_date 与 by_content 都是 false: 视为相同
+# - 只有 by_date 是 true: 修改时间不同则需要更新
+# - 只有 by_content 是 true: 内容不同则需要更新 (对比两边的 hash)
+# - 两者都是 true: 修改时间相同则视为相同，否则再对比内容
+# 文件的 hash 会记录在 ffe 的缓存中，文件没有变化 (体积与修改时间都相同) 时不必重新读取。
+# dry run 时会显示统计数据 (新增、更新、删除的文件数量与体积)。
+# 文件非常多时建议把 verbose 设为 false.
+# version: 2026-10-19
+# ffe >= v0.2.0
+"""
 
     @property  # 必须设为 @property
     def default_options(self) -> dict:
@@ -27,6 +97,9 @@ class OneWaySync(Recipe):
             delete=False,
             by_date=False,
             by_content=True,
+            ignore=[],
+            verbose=True,
+            use_pipe=False,
         )
 
     def validate(self, names: list[str], options: dict) -> ErrMsg:
@@ -38,25 +111,269 @@ class OneWaySync(Recipe):
         - self.by_date
         - self.by_content
         - self.ignore
+        - self.verbose
         - self.dst_dir
-        - self.names
+        - self.src_dir
         """
-        names, err = names_limit(names, 1)
+        # 要在 dry_run, exec 中确认 is_validated
+        self.is_validated = True
+
+        options = self.default_options | options
+        bools = {}
+        for key in ("add", "update", "delete", "by_date", "by_content", "verbose"):
+            bools[key], err = get_bool(options, key)
+            if err:
+                return err
+        self.add = bools["add"]
+        self.update = bools["update"]
+        self.delete = bools["delete"]
+        self.by_date = bools["by_date"]
+        self.by_content = bools["by_content"]
+        self.verbose = bools["verbose"]
+        if not (self.add or self.update or self.delete):
+            return "add, update, delete 不可全部设为 false"
+
+        self.ignore = options.get("ignore", [])
+        if not isinstance(self.ignore, list) or not all(
+            isinstance(x, str) for x in self.ignore
+        ):
+            return "Please set ignore to a list of strings, e.g. ['*.tmp']"
+
+        names, err = names_limit(names, 2, 2)
         if err:
             return err
-        err = must_exist(names)
+        err = must_folders(names)
         if err:
             return err
 
+        self.dst_dir, self.src_dir = Path(names[0]), Path(names[1])
+        dst, src = self.dst_dir.resolve(), self.src_dir.resolve()
+        if dst == src or dst in src.parents or src in dst.parents:
+            return f"{self.dst_dir} 与 {self.src_dir} 不可相同，也不可互相包含"
         return ""
 
-    def dry_run(self, really_move: bool = False) -> ErrMsg:
+    def dry_run(self, really_run: bool = False) -> Result:
         assert self.is_validated, "在执行 dry_run 之前必须先执行 validate"
-        return "coming soon... (本插件正在施工中)"
 
-    def exec(self) -> ErrMsg:
+        print(f"sync {self.src_dir} -> {self.dst_dir}")
+        self.errors: list[ErrMsg] = []
+        self.to_check: list[tuple[str, str, str, int]] = []
+        self.cache = open_cache() if self.by_content else None
+        try:
+            return self.sync(really_run)
+        finally:
+            if self.cache:
+                self.cache.close()
+
+    def sync(self, really_run: bool) -> Result:
+        counts = dict.fromkeys(("mkdir", "add", "update", "delete", "rmtree"), 0)
+        sizes = dict(add=0, update=0)
+        pairs: list[tuple[Path, Path]] = []
+        pending = 0  # pairs 的总体积
+
+        try:
+            for op, rel, size in self.diff():
+                counts[op] += 1
+                if op in sizes:
+                    sizes[op] += size
+                if self.verbose:
+                    print(f"-- {op} {rel}")
+                if not really_run:
+                    continue
+
+                src, dst = self.src_dir.joinpath(rel), self.dst_dir.joinpath(rel)
+                if op in ("add", "update"):
+                    pairs.append((src, dst))
+                    pending += size
+                    if len(pairs) >= batch_size:
+                        self.copy_batch(pairs, pending)
+                        pairs, pending = [], 0
+                    continue
+                try:
+                    match op:
+                        case "mkdir":
+                            dst.mkdir()
+                        case "delete":
+                            dst.unlink()
+                        case "rmtree":
+                            shutil.rmtree(dst)
+                except OSError as e:
+                    self.errors.append(str(e))
+        except OSError:
+            # 文件系统出错时仍复制已经排队的文件; 其他异常 (比如 KeyboardInterrupt) 则立即停止。
+            if pairs:
+                self.copy_batch(pairs, pending)
+            raise
+        if pairs:
+            self.copy_batch(pairs, pending)
+
+        print(
+            f"\nadd: {counts['add']} files ({sizes['add'] / MB:.2f} MB), "
+            f"update: {counts['update']} files ({sizes['update'] / MB:.2f} MB), "
+            f"mkdir: {counts['mkdir']}, "
+            f"delete: {counts['delete']} files, {counts['rmtree']} folders"
+        )
+        return [self.dst_dir.__str__()], errors_summary(self.errors)
+
+    def exec(self) -> Result:
         assert self.is_validated, "在执行 exec 之前必须先执行 validate"
-        return "coming soon... (本插件正在施工中)"
+        return self.dry_run(really_run=True)
+
+    def copy_batch(self, pairs: list[tuple[Path, Path]], size: int) -> None:
+        _, errors = copy_files(pairs)
+        self.errors.extend(errors)
+        get_reporter().add_bytes(size)
+
+    def scan(self, folder: Path) -> list[os.DirEntry] | None:
+        """返回按文件名排序的 folder 内容 (已排除 ignore), 出错时返回 None."""
+        try:
+            with os.scandir(folder) as it:
+                entries = [x for x in it if not self.is_ignored(x.name)]
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            self.errors.append(str(e))
+            return None
+        entries.sort(key=lambda x: x.name)
+        return entries
+
+    def is_ignored(self, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def diff(self) -> Iterator[Action]:
+        yield from self.walk_diff("")
+        yield from self.check_content()
+
+    def walk_diff(self, rel: str, dst_exists: bool = True) -> Iterator[Action]:
+        """对比 src_dir/rel 与 dst_dir/rel, 逐个产生需要执行的操作。
+
+        先产生 mkdir 再产生该文件夹内的文件，调用者按顺序执行即可。
+        dst_exists 为 false 表示 dst_dir/rel 是新建的文件夹 (dry run 时尚未建立)。
+        """
+        src_entries = self.scan(self.src_dir.joinpath(rel))
+        dst_entries = self.scan(self.dst_dir.joinpath(rel)) if dst_exists else []
+        if src_entries is None or dst_entries is None:
+            return  # 无法读取的文件夹整个跳过 (尤其不可删除任何东西)
+
+        i, j = 0, 0
+        while i < len(src_entries) or j < len(dst_entries):
+            s_name = src_entries[i].name if i < len(src_entries) else None
+            d_name = dst_entries[j].name if j < len(dst_entries) else None
+            if d_name is None or (s_name is not None and s_name < d_name):
+                if self.add:
+                    yield from self.copy_new(src_entries[i], os.path.join(rel, s_name))
+                i += 1
+            elif s_name is None or d_name < s_name:
+                if self.delete:
+                    yield remove(dst_entries[j], os.path.join(rel, d_name))
+                j += 1
+            else:
+                s, d = src_entries[i], dst_entries[j]
+                yield from self.compare(s, d, os.path.join(rel, s_name))
+                i += 1
+                j += 1
+
+    def copy_new(self, s: os.DirEntry, rel: str) -> Iterator[Action]:
+        match entry_kind(s):
+            case "dir":
+                yield ("mkdir", rel, 0)
+                yield from self.walk_diff(rel, dst_exists=False)
+            case "file":
+                if st := self.stat(s):
+                    yield ("add", rel, st.st_size)
+
+    def compare(self, s: os.DirEntry, d: os.DirEntry, rel: str) -> Iterator[Action]:
+        s_kind, d_kind = entry_kind(s), entry_kind(d)
+        if not s_kind:
+            return  # 特殊文件 (比如指向文件夹的链接) 不处理
+        if s_kind == d_kind == "dir":
+            yield from self.walk_diff(rel)
+            return
+        if s_kind != d_kind:
+            # 一边是文件，另一边是文件夹 (或特殊文件), 需要先删除再复制
+            if self.update:
+                yield remove(d, rel)
+                yield from self.copy_new(s, rel)
+            return
+        if not self.update:
+            return
+        a, b = self.stat(s), self.stat(d)
+        if a is None or b is None:
+            return
+        same = self.quick_check(a, b)
+        if same is None:
+            self.to_check.append((s.path, d.path, rel, a.st_size))
+            if len(self.to_check) >= check_batch:
+                yield from self.check_content()
+        elif not same:
+            yield ("update", rel, a.st_size)
+
+    def stat(self, entry: os.DirEntry) -> os.stat_result | None:
+        """出错时 (比如文件在扫描之后被删除) 记录错误并返回 None, 不影响其他文件。"""
+        try:
+            return entry.stat()
+        except OSError as e:
+            self.errors.append(str(e))
+            return None
+
+    def quick_check(self, a: os.stat_result, b: os.stat_result) -> bool | None:
+        """只根据体积与修改时间判断两个文件是否相同，需要对比内容时返回 None."""
+        if a.st_size != b.st_size:
+            return False
+        same_date = abs(a.st_mtime_ns - b.st_mtime_ns) < mtime_tolerance_ns
+        if self.by_date and same_date:
+            return True
+        if self.by_content:
+            return None
+        return not self.by_date
+
+    def check_content(self) -> Iterator[Action]:
+        """一起计算 self.to_check 里全部文件的 hash (优先使用缓存), 产生需要的 update.
+
+        这些文件所在的文件夹两边都存在，因此稍后才更新也不影响其他操作的顺序。
+        """
+        if not self.to_check:
+            return
+        files = [x for s, d, _, _ in self.to_check for x in (s, d)]
+        digests, errors = hash_files(files, cache=self.cache)
+        self.errors.extend(errors)
+        for s, d, rel, size in self.to_check:
+            if s not in digests or d not in digests:
+                continue  # 无法读取时不覆盖
+            if digests[s].digest != digests[d].digest:
+                yield ("update", rel, size)
+        self.to_check = []
 
 
 __recipe__ = OneWaySync
+
+
+def entry_kind(entry: os.DirEntry) -> str:
+    """返回 "dir", "file" 或空字符串 (特殊文件、指向文件夹的链接、失效的链接等)"""
+    if entry.is_dir(follow_symlinks=False):
+        return "dir"
+    if entry.is_file():
+        return "file"
+    return ""
+
+
+def remove(d: os.DirEntry, rel: str) -> Action:
+    if d.is_dir(follow_symlinks=False):
+        return ("rmtree", rel, 0)
+    return ("delete", rel, 0)
+
+
+def open_cache() -> HashCache | None:
+    """打开 hash 缓存，不可用时返回 None (hash_files 仍可直接计算)."""
+    try:
+        return HashCache()
+    except (sqlite3.Error, OSError) as e:
+        print(f"hash cache is not available: {e}")
+        return None
+
+
+def errors_summary(errors: list[ErrMsg]) -> ErrMsg:
+    if len(errors) > errors_limit:
+        more = len(errors) - errors_limit
+        errors = errors[:errors_limit] + [f"... and {more} more errors"]
+    return "\n".join(errors)
@@ -1,15 +1,25 @@
 """rename-part: 批量修改或删除文件名中的一部分。
 
 由于本插件专用于批量处理文件名中的一部分，因此可以自动选择需要处理的文件。
-对文件名的处理可选择三种模式: replace(替换字符), head(在开头添加字符), tail(在末尾添加字符)
+对文件名的处理可选择五种模式: replace(替换字符), head(在开头添加字符), tail(在末尾添加字符),
+regex(正则表达式替换), template(按模板生成新文件名)。
+
+改名前先在内存中生成全部 "旧名 -> 新名" 的对应关系，每个文件夹只遍历一次，
+用集合检查冲突，然后按依赖关系排序执行 (因此 a->b, b->c 这样的链条可以成功)，
+遇到循环 (比如 a->b, b->a) 则借用一个临时文件名打破循环。
 
 https://github.com/ahui2016/ffe/raw/main/recipes/rename-part.py
+version: 2026-10-19
 # ffe >= v0.1.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
+import os
+import re
 import glob
+import string
+from datetime import datetime
 from pathlib import Path
 from enum import Enum, auto
 from ffe.model import (
@@ -27,9 +37,15 @@ class EditMethod(Enum):
     Replace = auto()
     Head = auto()
     Tail = auto()
+    Regex = auto()
+    Template = auto()
+
 
+template_fields = ("n", "name", "stem", "suffix", "mtime", "size")
+"""template 模式可使用的字段"""
 
-new_filenames = set()
+Step = tuple[str, str]
+"""同一个文件夹内的一次改名 (旧文件名, 新文件名)"""
 
 
 # 每个插件都必须继承 model.py 里的 Recipe
@@ -46,17 +62,23 @@ recipe = "rename-part"  # 批量修改或删除文件名中的一部分
 names = [ "." ]        # 一个文件夹 或 多个文件 或 使用通配符
 
 [tasks.options]
-old = ""             # 需要被删除或修改的内容
-new = ""             # 新内容
-method = "replace"   # 有三种方法可选: replace / head / tail
+old = ""             # 需要被删除或修改的内容 (regex 模式下是正则表达式)
+new = ""             # 新内容 (regex 模式下可使用 \\1 等, template 模式下是模板)
+method = "replace"   # 有五种方法可选: replace / head / tail / regex / template
+start = 1            # template 模式下 {n} 的起始值
 auto = true          # 根据 old 自动选择文件，需要在 names 里指定一个文件夹
 use_glob = false     # 此项设为 true 时, names 应该使用通配符，如 '*.jpg'
 use_pipe = true      # 是否接受上一个任务的结果
 
-# 本插件的主要用法有两种：
+# 本插件的主要用法有三种：
 # 1. 自动根据 old 选择文件，并且把 old 更改为 new, 如果 new 是空字符串则相当于删除 old。
 # 2. method 设为 head 或 tail 时分别表示在文件名的开头或末尾添加 new 的内容。
+# 3. method 设为 template 时按模板生成新文件名，比如 new = "{mtime:%Y%m%d}-{n:04d}{suffix}",
+#    可用字段: n, name, stem, suffix, mtime, size; 此时 old 用于筛选文件 (空字符串表示全部)。
+# auto 或 use_glob 模式按文件名排序后编号，逐一指定文件时按 names 的顺序编号。
+# 只匹配文件名，不匹配文件夹路径。改名冲突 (新文件名已存在或重复) 的文件会被跳过。
 # 由于本插件比较复杂，不熟悉时建议多用 'ffe run -dry' 模式预估运行结果，确认无误再真正执行。
+# version: 2026-10-19
 # ffe >= v0.1.0
 """
 
@@ -66,6 +88,7 @@ use_pipe = true      # 是否接受上一个任务的结果
             old="",
             new="",
             method=EditMethod.Replace.name,
+            start=1,
             auto=True,
             use_glob=False,
             use_pipe=False,
@@ -76,10 +99,14 @@ use_pipe = true      # 是否接受上一个任务的结果
 
         - self.auto
         - self.use_glob
-        - self.names
+        - self.groups
         - self.old
         - self.new
         - self.method
+        - self.start
+        - self.pattern
+        - self.need_stat
+        - self.listings
         """
         # 要在 dry_run, exec 中确认 is_validated
         self.is_validated = True
@@ -91,21 +118,31 @@ use_pipe = true      # 是否接受上一个任务的结果
         except KeyError:
             return (
                 f"KeyError: '{wrong_key}'\n"
-                "Please set the method to 'replace', 'head' or 'tail'."
+                "Please set the method to 'replace', 'head', 'tail', 'regex' or 'template'."
             )
 
         self.old = options.get("old", "")
         self.new = options.get("new", "")
+        self.start = options.get("start", 1)
+        if not isinstance(self.start, int) or isinstance(self.start, bool):
+            return "Please set start to an integer"
         self.auto, e1 = get_bool(options, "auto")
         self.use_glob, e2 = get_bool(options, "use_glob")
         if e1 or e2:
             return f"{e1} {e2}"
 
-        # auto 模式只适用于 EditMethod.REPLACE
-        if self.auto and self.method is not EditMethod.Replace:
-            print("set auto to False because the method is not REPLACE")
+        err = self.init_method()
+        if err:
+            return err
+
+        # auto 模式不适用于 EditMethod.Head 与 EditMethod.Tail
+        if self.auto and self.method in (EditMethod.Head, EditMethod.Tail):
+            print(f"set auto to False because the method is {self.method.name.upper()}")
             self.auto = False
 
+        # 文件夹 -> 该文件夹内的全部文件名 (包括子文件夹名), 用于检查冲突
+        self.listings: dict[Path, set[str]] = {}
+
         # 优先采用 auto 模式，其次采用 use_glob 模式，当 auto 与 use_glob 都被设为 False 时
         # 才进入逐一指定具体文件的模式。
         if self.auto:
@@ -116,8 +153,8 @@ use_pipe = true      # 是否接受上一个任务的结果
             folder = Path(names[0])
             if not folder.is_dir():
                 return f"{folder} 不是文件夹\n当 auto=True 时需要指定一个文件夹"
-            all_names = folder.glob("*")
-            self.names = [x for x in all_names if self.old in x.__str__()]
+            self.groups = {folder: self.scan_folder(folder)}
+            return ""
         elif self.use_glob:
             print("use_glob: True")
             names, err = names_limit(names, 1, 1)
@@ -125,61 +162,163 @@ use_pipe = true      # 是否接受上一个任务的结果
                 return f"{err}\n当 use_glob=True 时要求 names 数量刚好等于 1"
             if names[0].find("**") >= 0:
                 return "do not support the “**” pattern"
-            self.names = [Path(x) for x in glob.glob(names[0])]
+            paths = sorted(Path(x) for x in glob.glob(names[0]))
         else:
             print("auto: False, use_glob: False")
             names, err = names_limit(names, 1)
             if err:
                 return f"{err}\n当 auto=False 且 use_glob=False 时要求 names 数量大于等于 1"
-            self.names = [Path(x) for x in names]
+            paths = [Path(x) for x in names]
 
-        self.names = filter_files(self.names)
-        return must_exist(self.names)
+        paths = filter_files(paths)
+        self.groups = group_by_folder(paths, self.start)
+        return must_exist(paths)
+
+    def init_method(self) -> ErrMsg:
+        """按 self.method 检查 old 与 new, 并初始化 self.pattern 与 self.need_stat"""
+        self.pattern: re.Pattern | None = None
+        self.need_stat = False
+
+        match self.method:
+            case EditMethod.Replace:
+                if not self.old:
+                    return "method 为 replace 时 old 不可为空"
+            case EditMethod.Regex:
+                if not self.old:
+                    return "method 为 regex 时 old 不可为空"
+                try:
+                    self.pattern = re.compile(self.old)
+                except re.error as e:
+                    return f"re.error: {e}\nold = '{self.old}'"
+            case EditMethod.Template:
+                if not self.new:
+                    return "method 为 template 时 new 不可为空"
+                try:
+                    fields = {
+                        field.split(".")[0].split("[")[0]
+                        for _, field, _, _ in string.Formatter().parse(self.new)
+                        if field is not None
+                    }
+                except ValueError as e:
+                    return f"ValueError: {e}\nnew = '{self.new}'"
+                unknown = fields - set(template_fields)
+                if unknown or "" in fields:
+                    return (
+                        f"unknown fields in template: {sorted(unknown) or ['{}']}\n"
+                        f"available fields: {', '.join(template_fields)}"
+                    )
+                self.need_stat = bool(fields & {"mtime", "size"})
+        return ""
+
+    def is_selected(self, filename: str) -> bool:
+        """auto 模式下根据 old 判断是否选择该文件 (只匹配文件名)"""
+        if self.pattern is not None:
+            return self.pattern.search(filename) is not None
+        return self.old in filename
+
+    def scan_folder(self, folder: Path) -> dict[str, int]:
+        """遍历一次 folder, 同时选择文件并记录全部文件名。返回 {文件名: 编号}.
+
+        DirEntry.is_file() 通常可直接使用目录项里的类型信息，不需要逐个 stat.
+        """
+        selected: list[str] = []
+        listing: set[str] = set()
+        with os.scandir(folder) as it:
+            for entry in it:
+                listing.add(entry.name)
+                if entry.is_file() and self.is_selected(entry.name):
+                    selected.append(entry.name)
+        self.listings[folder] = listing
+        selected.sort()
+        return {name: n for n, name in enumerate(selected, start=self.start)}
+
+    def new_name(self, folder: Path, name: str, n: int) -> str:
+        match self.method:
+            case EditMethod.Replace:
+                return name.replace(self.old, self.new)
+            case EditMethod.Head:
+                return self.new + name
+            case EditMethod.Tail:
+                stem, suffix = split_name(name)
+                return stem + self.new + suffix
+            case EditMethod.Regex:
+                assert self.pattern is not None
+                return self.pattern.sub(self.new, name)
+            case EditMethod.Template:
+                stem, suffix = split_name(name)
+                fields: dict = dict(n=n, name=name, stem=stem, suffix=suffix)
+                if self.need_stat:
+                    info = os.stat(os.path.join(folder, name))
+                    fields["mtime"] = datetime.fromtimestamp(info.st_mtime)
+                    fields["size"] = info.st_size
+                return self.new.format(**fields)
+        raise ValueError(self.method)
+
+    def make_plan(self) -> tuple[dict[Path, dict[str, str]], ErrMsg]:
+        """生成全部 "旧名 -> 新名" 的对应关系，按文件夹分组。
+
+        文件数量可能很多，因此这里只处理文件名字符串，不为每个文件创建 Path.
+        """
+        plan: dict[Path, dict[str, str]] = {}
+        for folder, names in self.groups.items():
+            renames = plan[folder] = {}
+            for name, n in names.items():
+                try:
+                    new = self.new_name(folder, name, n)
+                except (re.error, ValueError, IndexError, KeyError) as e:
+                    return {}, f"{type(e).__name__}: {e}\n{folder.joinpath(name)}"
+                except OSError as e:
+                    return {}, str(e)
+
+                if not new or new in (".", "..") or "/" in new or os.sep in new:
+                    old_path = folder.joinpath(name)
+                    print(f"Cannot rename '{old_path}' to '{new}'(invalid filename)")
+                    continue
+                if new != name:
+                    renames[name] = new
+        return plan, ""
+
+    def get_listing(self, folder: Path) -> set[str]:
+        listing = self.listings.get(folder)
+        if listing is None:
+            with os.scandir(folder) as it:
+                listing = {entry.name for entry in it}
+            self.listings[folder] = listing
+        return listing
 
     def dry_run(self, really_run: bool = False) -> Result:
         assert self.is_validated, "在执行 dry_run 之前必须先执行 validate"
 
         print(f"method: {self.method.name}\n")
         print("Before rename:")
-        for p in self.names:
-            print(smart_resolve(p).__str__())
+        for folder, names in self.groups.items():
+            base = smart_resolve(folder).__str__()
+            print("\n".join(os.path.join(base, x) for x in names))
 
         print("\nAfter rename:")
-        match self.method:
-            case EditMethod.Replace:
-                self.names_replace(really_run)
-            case EditMethod.Head:
-                self.names_add_head(really_run)
-            case EditMethod.Tail:
-                self.names_add_tail(really_run)
-
-        return list(new_filenames), ""
+        plan, err = self.make_plan()
+        if err:
+            return [], err
+
+        result: list[str] = []
+        for folder, renames in plan.items():
+            renames = drop_conflicts(folder, renames, self.get_listing(folder))
+            steps = order_renames(renames, self.get_listing(folder))
+            if really_run:
+                err = run_steps(folder, steps)
+                if err:
+                    return result, err
+            base = smart_resolve(folder).__str__()
+            new_paths = [os.path.join(base, x) for x in renames.values()]
+            print("\n".join(new_paths))
+            result.extend(new_paths)
+
+        return result, ""
 
     def exec(self) -> Result:
         assert self.is_validated, "在执行 exec 之前必须先执行 validate"
         return self.dry_run(really_run=True)
 
-    def names_replace(self, really_run: bool) -> None:
-        for old_path in self.names:
-            # old_path = smart_resolve(old_path)
-            new_name = old_path.resolve().name.replace(self.old, self.new)
-            new_path = old_path.with_name(new_name)
-            check_print_run(old_path, new_path, really_run)
-
-    def names_add_head(self, really_run: bool) -> None:
-        for old_path in self.names:
-            old_path = smart_resolve(old_path)
-            new_name = self.new + old_path.name
-            new_path = old_path.with_name(new_name)
-            check_print_run(old_path, new_path, really_run)
-
-    def names_add_tail(self, really_run: bool) -> None:
-        for old_path in self.names:
-            old_path = smart_resolve(old_path)
-            new_stem = old_path.stem + self.new
-            new_path = old_path.with_stem(new_stem)
-            check_print_run(old_path, new_path, really_run)
-
 
 __recipe__ = RenamePart
 
@@ -191,19 +330,112 @@ def smart_resolve(p: Path) -> Path:
     return p
 
 
-def check_print_run(before: Path, after: Path, really_run: bool) -> None:
-    before_str, after_str = before.__str__(), after.__str__()
-
-    if not after_str:
-        print(f"Cannot rename '{before_str}' to a blank filename.")
-        return
-
-    if after.exists() or after_str in new_filenames:
-        print(f"Cannot rename '{before_str}' to '{after_str}'(exists)")
-        return
-
-    if really_run:
-        before.rename(after)
-
-    new_filenames.add(after_str)
-    print(after_str)
+def group_by_folder(paths: list[Path], start: int) -> dict[Path, dict[str, int]]:
+    """按文件夹分组，返回 {文件夹: {文件名: 编号}}, 编号按 paths 的顺序。"""
+    groups: dict[Path, dict[str, int]] = {}
+    for n, p in enumerate(paths, start=start):
+        groups.setdefault(p.parent, {})[p.name] = n
+    return groups
+
+
+def split_name(name: str) -> tuple[str, str]:
+    """把文件名分为 stem 与 suffix (与 Path.stem, Path.suffix 相同)"""
+    stem, suffix = os.path.splitext(name)
+    if suffix == ".":
+        return name, ""
+    return stem, suffix
+
+
+def drop_conflicts(
+    folder: Path, renames: dict[str, str], listing: set[str]
+) -> dict[str, str]:
+    """剔除有冲突的改名，返回剩下的改名。
+
+    新文件名已存在 (并且该文件不会被改走) 或者与前面的改名重复，都算冲突。
+    被剔除的文件留在原地，可能又会挡住别的改名，因此重复检查直至没有冲突。
+    """
+    renames = dict(renames)
+    changed = True
+    while changed:
+        changed = False
+        claimed: set[str] = set()
+        for old, new in list(renames.items()):
+            if (new in listing and new not in renames) or new in claimed:
+                print(f"Cannot rename '{folder.joinpath(old)}' to '{new}'(exists)")
+                del renames[old]
+                changed = True
+            else:
+                claimed.add(new)
+    return renames
+
+
+def order_renames(renames: dict[str, str], listing: set[str]) -> list[Step]:
+    """把改名排序，使每一步的新文件名在执行时都不存在。
+
+    由于新文件名互不重复，改名关系只能组成若干条链与环。
+    链从末端 (新文件名不会被改走的那一步) 开始倒序执行;
+    环先把其中一个文件改成临时文件名，最后再改成它的新文件名。
+    """
+    wanted_by = {new: old for old, new in renames.items()}
+    steps: list[Step] = []
+    done: set[str] = set()
+
+    for old, new in renames.items():
+        if new in renames:
+            continue  # 不是链的末端
+        cur: str | None = old
+        while cur is not None:
+            steps.append((cur, renames[cur]))
+            done.add(cur)
+            cur = wanted_by.get(cur)
+
+    temp_names = temp_name_generator(listing, wanted_by)
+    for old in renames:
+        if old in done:
+            continue
+        temp = next(temp_names)
+        steps.append((old, temp))
+        done.add(old)
+        cur = wanted_by[old]
+        while cur != old:
+            steps.append((cur, renames[cur]))
+            done.add(cur)
+            cur = wanted_by[cur]
+        steps.append((temp, renames[old]))
+
+    return steps
+
+
+def temp_name_generator(listing: set[str], taken: dict[str, str]):
+    i = 0
+    while True:
+        name = f".ffe-rename-{os.getpid()}-{i}"
+        i += 1
+        if name not in listing and name not in taken:
+            yield name
+
+
+def run_steps(folder: Path, steps: list[Step]) -> ErrMsg:
+    """在 folder 内依次执行改名。
+
+    支持 dir_fd 的系统上只打开一次文件夹，每次改名都不必重新解析文件夹路径。
+    """
+    use_fd = os.rename in os.supports_dir_fd
+    fd = os.open(folder, os.O_RDONLY) if use_fd else None
+    done = 0
+    try:
+        for old, new in steps:
+            if fd is None:
+                os.rename(folder.joinpath(old), folder.joinpath(new))
+            else:
+                os.rename(old, new, src_dir_fd=fd, dst_dir_fd=fd)
+            done += 1
+    except OSError as e:
+        return (
+            f"{e}\n在 {folder} 内完成了 {done}/{len(steps)} 步改名，"
+            f"出错的一步: '{old}' -> '{new}'"
+        )
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return ""
@@ -1,14 +1,23 @@
 """swap: 对调两个文件的文件名
 
 只能用于不需要移动文件的情况，比如同一个文件夹（或同一个硬盘分区）内的文件可以操作，
-而跨硬盘分区的文件则无法处理。
+而跨硬盘分区的文件则无法处理。也可以对调两个文件夹，或一次对调很多对文件。
+
+在 Linux 上使用 renameat2(RENAME_EXCHANGE) 一步完成对调 (原子操作，中途崩溃也不会留下临时文件)，
+系统或文件系统不支持时才退回到 "临时文件名 + 三次改名" 的方法。
 
 https://github.com/ahui2016/ffe/raw/main/recipes/swap.py
+version: 2026-10-19
 # ffe >= v0.1.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
+import os
+import sys
+import errno
+import ctypes
+import tempfile
 from pathlib import Path
 from ffe.model import (
     Recipe,
@@ -16,7 +25,6 @@ from ffe.model import (
     Result,
     must_exist,
     get_bool,
-    must_files,
     names_limit,
 )
 
@@ -26,6 +34,37 @@ suffix = "1"
 suffix_limit = 20
 """限制最多可连续添加多少次 suffix, 避免文件名无限变长"""
 
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+"""见 linux/fcntl.h 与 linux/fs.h"""
+
+unsupported_errors = (errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP)
+"""renameat2 返回这些错误时表示内核或文件系统不支持 RENAME_EXCHANGE
+
+EINVAL 既可能表示文件系统不支持，也可能是真正的错误，需要用 exchange_supported 试探。
+"""
+
+exchange_support: dict[int, bool] = {}
+"""各硬盘分区 (st_dev) 是否支持 RENAME_EXCHANGE"""
+
+
+def load_renameat2():
+    """通过 ctypes 取得 libc 的 renameat2, 不可用时返回 None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.renameat2  # glibc >= 2.28
+    except (OSError, AttributeError):
+        return None
+    c_int, c_char_p = ctypes.c_int, ctypes.c_char_p
+    func.argtypes = [c_int, c_char_p, c_int, c_char_p, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+renameat2 = load_renameat2()
+
 
 # 每个插件都必须继承 model.py 里的 Recipe
 class Swap(Recipe):
@@ -38,28 +77,33 @@ class Swap(Recipe):
         return """
 [[tasks]]
 recipe = "swap"  # 对调两个文件名
-names = [        # 文件名数量必须是正好两个
+names = [        # 文件名数量必须是双数，每两个为一对
   'file1.txt',
   'file2.txt',
 ]
 
 [tasks.options]
+pairs_file = ""  # 从文本文件读取需要对调的名单，每行一对，用 Tab 分隔
 verbose = true   # 显示或不显示程序执行的详细过程
 use_pipe = true  # 是否接受上一个任务的结果
 
 # swap 只能用于不需要移动文件的情况，比如同一个文件夹 (或同一个硬盘分区)
 # 内的文件可以操作，而跨硬盘分区的文件则无法处理。
+# 可以对调文件，也可以对调文件夹。
+# 设置了 pairs_file 时 names 可以为空，pairs_file 里的空行与 # 开头的行会被忽略。
+# 在 Linux 上使用 renameat2(RENAME_EXCHANGE) 原子地对调，不支持时改用临时文件名。
+# version: 2026-10-19
 # ffe >= v0.1.0
 """
 
     @property  # 注意: 必须有 @property
     def default_options(self) -> dict:
-        return dict(use_pipe=False, verbose=True)
+        return dict(use_pipe=False, verbose=True, pairs_file="")
 
     def validate(self, names: list[str], options: dict) -> ErrMsg:
         """初步检查参数（比如文件数量与是否存在），并初始化以下项目：
 
-        - self.names
+        - self.pairs
         - self.verbose
         """
         # 要在 dry_run, exec 中确认 is_validated
@@ -70,49 +114,178 @@ use_pipe = true  # 是否接受上一个任务的结果
         if err:
             return err
 
-        self.names, err = names_limit(names, 2, 2)
+        pairs_file = options.get("pairs_file", "")
+        names, err = names_limit(names, 0 if pairs_file else 2)
         if err:
             return err
-        err = must_exist(self.names)
+        if len(names) % 2:
+            return f"expected: an even number of names, got: {names}"
+        self.pairs = list(zip(names[0::2], names[1::2]))
+
+        if pairs_file:
+            pairs, err = read_pairs(pairs_file)
+            if err:
+                return err
+            self.pairs.extend(pairs)
+        if not self.pairs:
+            return "nothing to swap"
+
+        all_names = [x for pair in self.pairs for x in pair]
+        err = must_exist(all_names)
         if err:
             return err
-        return must_files(self.names)
+        return check_pairs(self.pairs)
 
     def dry_run(self) -> Result:
         assert self.is_validated, "在执行 dry_run 之前必须先执行 validate"
 
-        name1, name2 = Path(self.names[0]), Path(self.names[1])
-        print(f"Start to swap {name1} and {name2}")
-        temp, err = temp_name(name1)
-        if err:
-            return [], err
-        print(f"-- found a safe temp name: {temp}")
-        print(f"-- rename {name1} to {temp}")
-        print(f"-- rename {name2} to {name1}")
-        print(f"-- rename {temp} to {name2}")
-        print(f"swap files OK: {name1} and {name2}")
+        for name1, name2 in self.pairs:
+            print(f"Start to swap {name1} and {name2}")
+            if renameat2 is not None:
+                print("-- exchange them with renameat2(RENAME_EXCHANGE)")
+            else:
+                temp, err = temp_name(Path(name1))
+                if err:
+                    return [], err
+                print_steps(Path(name1), Path(name2), temp)
+            print(f"swap OK: {name1} and {name2}")
         return [], ""
 
     def exec(self) -> Result:
         assert self.is_validated, "在执行 exec 之前必须先执行 validate"
 
-        name1, name2 = Path(self.names[0]), Path(self.names[1])
-        temp, err = temp_name(name1)
-        if err:
-            return [], err
+        for i, (name1, name2) in enumerate(self.pairs):
+            temp, err = swap(Path(name1), Path(name2))
+            if err:
+                if i > 0:
+                    err = f"{err}\n(already swapped {i}/{len(self.pairs)} pairs)"
+                return [], err
+
+            # 这个插件本来不需要 verbose, 只是为了当作使用 options 的示例，因此简单处理。
+            if self.verbose:
+                print(f"Start to swap {name1} and {name2}")
+                if temp is None:
+                    print("-- exchange them with renameat2(RENAME_EXCHANGE)")
+                else:
+                    print_steps(Path(name1), Path(name2), temp)
+            print(f"swap OK: {name1} and {name2}")
+        return [], ""
+
+
+__recipe__ = Swap
+
+
+def read_pairs(pairs_file: str) -> tuple[list[tuple[str, str]], ErrMsg]:
+    """读取 pairs_file, 每行两个文件名，用 Tab 分隔。"""
+    pairs = []
+    try:
+        with open(pairs_file, encoding="utf-8") as f:
+            for i, line in enumerate(f, start=1):
+                line = line.rstrip("\r\n")
+                if not line.strip() or line.lstrip().startswith("#"):
+                    continue
+                fields = [x.strip() for x in line.split("\t")]
+                if len(fields) != 2 or not all(fields):
+                    return [], f"{pairs_file}:{i}: expected 'name1<Tab>name2'"
+                pairs.append((fields[0], fields[1]))
+    except OSError as e:
+        return [], str(e)
+    return pairs, ""
+
+
+def check_pairs(pairs: list[tuple[str, str]]) -> ErrMsg:
+    """同一个文件不可出现两次，也不可在另一个文件夹之内;
+    每一对必须在同一个硬盘分区内。
+    """
+    seen: dict[tuple[str, ...], str] = {}
+    for name1, name2 in pairs:
+        for name in (name1, name2):
+            key = Path(os.path.abspath(name)).parts
+            if key in seen:
+                return f"{name} appears more than once"
+            seen[key] = name
+        if os.lstat(name1).st_dev != os.lstat(name2).st_dev:
+            return f"{name1} and {name2} are not on the same device"
+
+    # 排序后，一个文件夹之内的文件紧跟在该文件夹之后
+    keys = sorted(seen)
+    for parent, child in zip(keys, keys[1:]):
+        if child[: len(parent)] == parent:
+            return f"{seen[child]} is inside {seen[parent]}"
+    return ""
+
+
+def exchange_supported(name: Path) -> bool:
+    """在 name 所在的文件夹里对调两个临时文件，试探是否支持 RENAME_EXCHANGE."""
+    folder = name.absolute().parent
+    dev = os.lstat(folder).st_dev
+    if dev not in exchange_support:
+        assert renameat2 is not None
+        try:
+            with tempfile.TemporaryDirectory(dir=folder, prefix=".swap-") as temp:
+                a, b = Path(temp, "a"), Path(temp, "b")
+                a.touch()
+                b.touch()
+                r = renameat2(
+                    AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE
+                )
+        except OSError:
+            return False  # 无法试探，按不支持处理
+        exchange_support[dev] = r == 0
+    return exchange_support[dev]
+
+
+def swap(name1: Path, name2: Path) -> tuple[Path | None, ErrMsg]:
+    """对调 name1 与 name2, 返回使用过的临时文件名 (原子对调时返回 None)."""
+    global renameat2
+    if renameat2 is not None:
+        r = renameat2(
+            AT_FDCWD, os.fsencode(name1), AT_FDCWD, os.fsencode(name2), RENAME_EXCHANGE
+        )
+        if r == 0:
+            return None, ""
+        code = ctypes.get_errno()
+        unsupported = code in unsupported_errors or (
+            code == errno.EINVAL and not exchange_supported(name1)
+        )
+        if not unsupported:
+            return None, f"{os.strerror(code)}: {name1}, {name2}"
+        if code == errno.ENOSYS:
+            renameat2 = None  # 内核不支持，以后不必再尝试
+
+    temp, err = temp_name(name1)
+    if err:
+        return None, err
+    try:
         name1.rename(temp)
+    except OSError as e:
+        return None, str(e)
+    try:
         name2.rename(name1)
+    except OSError as e:
+        return None, rollback(e, [(temp, name1)])
+    try:
         temp.rename(name2)
+    except OSError as e:
+        return None, rollback(e, [(name1, name2), (temp, name1)])
+    return temp, ""
 
-        # 这个插件本来不需要 verbose, 只是为了当作使用 options 的示例，因此简单处理。
-        if self.verbose:
-            self.dry_run()
-        else:
-            print(f"swap files OK: {name1} and {name2}")
-        return [], ""
 
+def rollback(err: OSError, steps: list[tuple[Path, Path]]) -> ErrMsg:
+    """对调失败时按 steps 改回原来的文件名，返回错误信息。"""
+    try:
+        for src, dst in steps:
+            src.rename(dst)
+    except OSError as e:
+        return f"{err}\n(failed to roll back: {e})"
+    return f"{err}\n(rolled back)"
 
-__recipe__ = Swap
+
+def print_steps(name1: Path, name2: Path, temp: Path) -> None:
+    print(f"-- found a safe temp name: {temp}")
+    print(f"-- rename {name1} to {temp}")
+    print(f"-- rename {name2} to {name1}")
+    print(f"-- rename {temp} to {name2}")
 
 
 def temp_name(name: Path) -> tuple[Path, ErrMsg]:
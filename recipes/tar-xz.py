@@ -1,28 +1,137 @@
 """tar-xz: 打包压缩/解压缩文件
 
 使用打包压缩功能时，需要先进入一个文件夹，用相对路径选择需要打包的文件/文件夹。
-采用 lzma 压缩方法，打包压缩后的后缀名是 '.tar.xz'
+默认采用 lzma 压缩方法，打包压缩后的后缀名是 '.tar.xz', 也可选择 gz, bz2, zstd 或不压缩。
 
 https://github.com/ahui2016/ffe/raw/main/recipes/tar-xz.py
-version: 2022-01-20
-# ffe >= v0.1.0
+version: 2026-10-19
+# ffe >= v0.2.0
 """
 
 # 每个插件都应如上所示在文件开头写简单介绍，以便 "ffe install --peek" 功能窥视插件概要。
 
+import io
+import os
+import bz2
+import json
+import bisect
+import fnmatch
+import hashlib
+import gzip
+import lzma
+import stat
+import time
+import struct
+import shutil
 import tarfile
-from pathlib import Path
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
 from enum import Enum, auto
-from ffe.model import Recipe, ErrMsg, Result, must_exist, names_limit
+from typing import IO, Callable, Iterator, NamedTuple
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+from ffe.model import (
+    Recipe,
+    ErrMsg,
+    Result,
+    MB,
+    get_bool,
+    get_reporter,
+    get_throttle,
+    must_exist,
+    names_limit,
+    open_throttled,
+    process_pool,
+)
+from ffe.util import app_data_dir, write_atomic
 
-suffix = ".tar.xz"
+
+codec_suffixes = {
+    "xz": ".tar.xz",
+    "gz": ".tar.gz",
+    "bz2": ".tar.bz2",
+    "zstd": ".tar.zst",
+    "none": ".tar",
+}
+"""压缩方法与对应的后缀名"""
+
+codec_magic = [
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+"""解压缩时根据文件开头的几个字节 (magic bytes) 判断压缩方法，而不是根据后缀名。"""
+
+codec_levels = {"xz": (0, 9), "gz": (0, 9), "bz2": (1, 9), "zstd": (-7, 22)}
+"""各压缩方法的 level 取值范围"""
+
+auto_candidates = [
+    ("none", -1),
+    ("zstd", 3),
+    ("gz", 1),
+    ("gz", 6),
+    ("zstd", 19),
+    ("bz2", 9),
+    ("xz", 1),
+    ("xz", 6),
+]
+"""codec = "auto" 时尝试的压缩方法与 level"""
+
+auto_sample_size = 4 * MB
+"""codec = "auto" 时用来试压缩的样本大小"""
+
+tar_index_dir = app_data_dir.joinpath("tar-index")
+"""压缩包的文件索引保存在这里，同一个压缩包再次检查时不需要再解压缩。"""
+
+tar_index_limit = 200
+"""最多保存多少个压缩包的索引，超过时删除最旧的。"""
+
+tar_index_version = 1
+
+inline_size = 4 * MB
+"""多线程解压时，大于 inline_size 的文件由读取线程直接写入，不放进队列 (避免占用过多内存)。"""
+
+extract_filter = getattr(tarfile, "data_filter", None)
+"""Python 3.11.4 以上的 tarfile 自带的安全检查 (拒绝绝对路径、指向外部的链接等)"""
+
+extract_kwargs = {} if extract_filter is None else dict(filter=extract_filter)
+
+snapshot_suffix = ".snapshot.json"
+"""增量打包的快照文件后缀名"""
+
+incremental_marker = ".ffe-incremental.json"
+"""增量压缩包内记录已删除文件的文件名 (总是最后一个)"""
+
+per_item_max = 9999
+"""per_item 模式下 names 的数量上限"""
+
+add_orders = ("name", "inode", "extent")
+"""打包时添加文件的顺序"""
+
+FS_IOC_FIEMAP = 0xC020660B
+"""Linux 的 ioctl, 用于查询文件数据在磁盘上的物理位置"""
+
+seek_gap = 16 * MB
+"""按索引解压个别文件时，如果下一个文件与当前位置的距离超过 seek_gap, 则重新定位，否则顺序读取过去。"""
 
 
 class Mode(Enum):
     Auto = auto()
     Zip = auto()
     Unzip = auto()
+    Restore = auto()
 
 
 # 每个插件都必须继承 model.py 里的 Recipe
@@ -36,7 +145,7 @@ class TarXZ(Recipe):
         return """
 [[tasks]]
 recipe = "tar-xz"  # 打包压缩/解压缩文件
-names = [          # 如果提供 1 个文件，并且后缀是 '.tar.xz',
+names = [          # 如果提供 1 个文件，并且是压缩包 (比如 '.tar.xz'),
     'file.tar.xz'  # 则自动进入解压缩模式，否则进入打包压缩模式。
 ]
 
@@ -45,13 +154,44 @@ output = ""        # 指定压缩后的文件名或解压缩时的目标文件
                    # 如果留空，本插件会为你自动设置。
 auto_wrap = true   # 解压缩出来不止一个文件时，用一个文件夹包裹它们
 use_pipe = true    # 是否接受上一个任务的结果
+members = []       # 解压缩时只解压这些文件 (可使用通配符，如 'etc/*.conf'), 留空表示全部
+writers = 4        # 解压缩时使用多少个线程写入文件，设为 1 则不使用多线程
 zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
+incremental = false    # 增量打包: 只打包上次打包后新增/修改的文件
+snapshot_hash = false  # 增量打包时，文件的修改时间变了但内容没变，则不打包
+per_item = false   # 每个文件/文件夹各自打包成一个压缩包
+order = "name"     # 添加文件的顺序: name / inode / extent
+codec = "xz"       # 压缩方法: xz / gz / bz2 / zstd / none / auto
+level = -1         # 压缩级别，-1 表示采用该压缩方法的默认级别
+time_budget = 0    # codec 为 auto 时，允许压缩花费的时间 (单位: 秒), 0 表示不限
+threads = 1        # 打包压缩时使用多少个进程，设为 0 则使用全部 CPU 核心
+block_size = 16    # 多进程压缩时每个数据块的大小 (单位: MB)
 
 使用打包压缩功能时，需要先进入一个文件夹，用相对路径选择需要打包的文件/文件夹。
-采用 lzma 压缩方法，打包压缩后的后缀名是 '.tar.xz'
-解压缩时每次只能解压缩一个文件。
-# version: 2022-01-20
-# ffe >= v0.1.0
+默认采用 lzma 压缩方法，打包压缩后的后缀名是 '.tar.xz'
+codec 可选 xz, gz, bz2, none (只打包不压缩), zstd (需要 Python 3.14 或安装 zstandard),
+设为 auto 时会先用一部分数据试压缩，在 time_budget 内选择压缩后体积最小的方法，
+如果数据已经是压缩过的 (比如照片、视频)，通常会选择 none.
+threads 大于 1 时 (只对 xz 有效)，数据被分成多块同时压缩，
+生成的仍是标准的 .xz 文件 (xz -d 可以解压)。
+解压缩时根据文件内容自动识别压缩方法，每次只能解压缩一个文件。
+解压缩时由一个线程读取压缩包，同时由 writers 个线程写入文件，
+适合解压含有大量小文件的压缩包。
+incremental 为 true 时，在压缩包旁边保存快照 'output.snapshot.json', 每次生成
+'output.0001.tar.xz', 'output.0002.tar.xz' ... 只含新增/修改的文件以及已删除文件的清单。
+per_item 为 true 时，names 中的每一项各自打包 (比如 'a' => 'a.tar.xz')，
+output 是存放压缩包的文件夹 (留空表示当前文件夹)，threads 是同时打包的进程数，
+体积大的先打包。
+order 设为 inode 或 extent 时，先扫描全部文件，文件夹按名称排在前面，
+其余文件按 inode 或数据在磁盘上的物理位置 (需要 Linux 的 FIEMAP, 不支持时按 inode) 排序，
+可以减少机械硬盘和某些网络文件系统的随机寻道。
+names 设为快照文件 (比如 'output.snapshot.json') 则按顺序解压全部增量压缩包，恢复最新状态
+(覆盖 output 里的同名文件，因此可以在已有的文件夹上再次恢复)。
+指定 members 时保持文件在压缩包内的路径 (不自动包裹文件夹)，选中文件夹则包括其中全部文件。
+由本插件以 threads > 1 压缩的 .tar.xz 以及未压缩的 .tar 可以直接定位到所需的数据块，
+不需要解压整个压缩包; 其他压缩包则顺序读取，找到全部文件后立即停止。
+# version: 2026-10-19
+# ffe >= v0.2.0
 """
 
     @property  # 必须设为 @property
@@ -59,7 +199,18 @@ zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
         return dict(
             output="",
             auto_wrap=True,
+            members=[],
+            writers=4,
             zip_overwrite=False,
+            incremental=False,
+            snapshot_hash=False,
+            per_item=False,
+            order="name",
+            codec="xz",
+            level=-1,
+            time_budget=0,
+            threads=1,
+            block_size=16,
             use_pipe=False,
         )
 
@@ -69,33 +220,71 @@ zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
         - self.output
         - self.mode
         - self.names
+        - self.index (解压缩时, 指定 members 时可能为 None)
+        - self.members
+        - self.writers
         - self.zip_overwrite
+        - self.incremental, self.snapshot_hash, self.snapshot_file, self.snapshot
+        - self.per_item, self.archives (per_item 模式下每个 name 对应的压缩包)
+        - self.order
+        - self.codec
+        - self.level
+        - self.threads
+        - self.block_size
         """
         # 要在 dry_run, exec 中确认 is_validated
         self.is_validated = True
 
-        names, err = names_limit(names, 1)
+        self.per_item, err = get_bool(options, "per_item")
+        if err:
+            return err
+        if self.per_item:
+            names, err = names_limit(names, 1, per_item_max)
+        else:
+            names, err = names_limit(names, 1)
         if err:
             return err
         err = must_exist(names)
         if err:
             return err
 
-        if len(names) == 1 and Path(names[0]).is_file() and names[0].endswith(suffix):
-            self.mode = Mode.Unzip
-        else:
+        self.codec = ""
+        if self.per_item:
             self.mode = Mode.Zip
+        elif len(names) == 1 and names[0].endswith(snapshot_suffix):
+            self.mode = Mode.Restore
+        else:
+            if len(names) == 1 and Path(names[0]).is_file():
+                self.codec = detect_tar(names[0])
+            self.mode = Mode.Unzip if self.codec else Mode.Zip
 
         self.names = names
+        self.members = options.get("members", [])
+        if not isinstance(self.members, list) or not all(
+            isinstance(x, str) and x.strip() for x in self.members
+        ):
+            return '"members" should be a list of file names'
+        self.members = [normalize_member(x) for x in self.members]
+        self.writers = options.get("writers", 4)
+        if not isinstance(self.writers, int) or self.writers < 1:
+            return '"writers" should be 1 or larger'
         self.zip_overwrite = options.get("zip_overwrite", False)
         output = options.get("output", "").strip()
         auto_wrap = options.get("auto_wrap", True)
 
         match self.mode:
-            case Mode.Unzip:
-                with tarfile.open(self.names[0]) as tar:
-                    only_one = len(tar.getnames()) == 1
+            case Mode.Restore:
+                self.snapshot_file = Path(self.names[0])
+                self.snapshot, err = load_snapshot(self.snapshot_file)
+                if err:
+                    return err
+                if not self.snapshot["archives"]:
+                    return f"No archive in '{self.snapshot_file}'"
+                self.output = Path.cwd().joinpath(output).resolve()
 
+            case Mode.Unzip:
+                if self.codec == "zstd" and not zstd_module():
+                    return "zstd is not supported (需要 Python 3.14 或安装 zstandard)"
                 if output:
                     # 如果指定了 output, 则必须确保那是一个存在的文件夹
                     self.output = Path.cwd().joinpath(output).resolve()
@@ -103,24 +292,110 @@ zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
                     # 未指定 output，则解压缩到当前文件夹。
                     self.output = Path.cwd()
 
+                if self.members:
+                    # 只解压个别文件时，如果还没有索引则不生成 (生成索引需要读取整个压缩包)。
+                    self.index = load_index(self.names[0])
+                    if self.index and self.index.codec != self.codec:
+                        self.index = None
+                    return ""
+
+                self.index = get_index(self.names[0], self.codec)
+                only_one = len(self.index.members) == 1
+
                 # auto_wrap 为真并且不止一个文件时，利用压缩文件的文件名作为文件夹。
                 if auto_wrap and not only_one:
-                    folder = self.names[0].removesuffix(suffix)
+                    folder = archive_stem(self.names[0])
                     self.output = self.output.joinpath(folder).resolve()
 
             case Mode.Zip:
+                self.threads = options.get("threads", 1)
+                if not isinstance(self.threads, int) or self.threads < 0:
+                    return '"threads" should be 0 or larger'
+                if self.threads == 0:
+                    self.threads = os.cpu_count() or 1
+                self.block_size = options.get("block_size", 16)
+                if not isinstance(self.block_size, int) or self.block_size < 1:
+                    return '"block_size" should be 1 or larger'
+
+                err = self.validate_codec(options)
+                if err:
+                    return err
+
+                self.order = options.get("order", "name")
+                if self.order not in add_orders:
+                    return f'"order" should be one of {", ".join(add_orders)}'
+
+                self.incremental = options.get("incremental", False)
+                self.snapshot_hash = options.get("snapshot_hash", False)
+                if self.per_item:
+                    if self.incremental:
+                        return "per_item and incremental cannot be used together"
+                    return self.validate_per_item(output)
+
                 # 如果 options 里未指定 output 文件名，则自动赋予一个合理的文件名。
                 if not output:
                     if len(self.names) == 1:
                         output = Path(self.names[0]).name
                     else:
                         output = Path.cwd().name
+                suffix = codec_suffixes[self.codec]
                 if output.endswith(suffix):
                     self.output = Path(output)
                 else:
-                    # 如果 output 文件名后缀不是 '.tar.xz', 则自动添加后缀。
+                    # 如果 output 文件名后缀与压缩方法不符，则自动添加后缀。
                     self.output = Path(output + suffix)
 
+                if self.incremental:
+                    # 增量打包: output 是系列名，每次生成的压缩包依次编号。
+                    series = archive_stem(str(self.output))
+                    self.snapshot_file = Path(series + snapshot_suffix)
+                    self.snapshot, err = load_snapshot(self.snapshot_file)
+                    if err:
+                        return err
+                    n = len(self.snapshot["archives"]) + 1
+                    self.output = Path(f"{series}.{n:04d}{suffix}")
+
+        return ""
+
+    def validate_per_item(self, output: str) -> ErrMsg:
+        """per_item 模式: 每个 name 各自打包，output 是存放压缩包的文件夹。"""
+        self.output = Path(output)
+        if output and not self.output.is_dir():
+            return f"Not a folder: '{output}'"
+        self.archives: dict[str, Path] = {}
+        for name in self.names:
+            archive = self.output.joinpath(Path(name).resolve().name)
+            archive = archive.with_name(archive.name + codec_suffixes[self.codec])
+            if archive in self.archives.values():
+                return f"Duplicate archive name: '{archive}'"
+            self.archives[name] = archive
+        return ""
+
+    def validate_codec(self, options: dict) -> ErrMsg:
+        """检查并设置 self.codec, self.level (codec 为 auto 时会试压缩一部分数据)"""
+        self.codec = options.get("codec", "xz")
+        self.level = options.get("level", -1)
+        if not isinstance(self.level, int):
+            return '"level" should be an integer'
+
+        if self.codec == "auto":
+            budget = options.get("time_budget", 0)
+            if not isinstance(budget, (int, float)) or budget < 0:
+                return '"time_budget" should be 0 or larger'
+            self.codec, self.level = choose_codec(self.names, budget)
+            return ""
+
+        if self.codec not in codec_suffixes:
+            return (
+                f"unknown codec: '{self.codec}'\n"
+                f"Please set the codec to one of {', '.join(codec_suffixes)} or auto."
+            )
+        if self.codec == "zstd" and not zstd_module():
+            return "zstd is not supported (需要 Python 3.14 或安装 zstandard)"
+        if self.level != -1 and self.codec in codec_levels:
+            low, high = codec_levels[self.codec]
+            if not low <= self.level <= high:
+                return f'"level" of {self.codec} should be between {low} and {high}'
         return ""
 
     def dry_run(self) -> Result:
@@ -128,24 +403,102 @@ zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
         print(f"Mode: {self.mode.name}")
         match self.mode:
             case Mode.Unzip:
-                with tarfile.open(self.names[0]) as tar:
-                    for name in tar.getnames():
-                        if Path(name).is_absolute():
-                            return [], "压缩包内含有绝对路径的文件名，请使用专业工具处理。"
-                        if name.startswith(".."):
-                            return [], f"{name} 可能会解压缩到父目录，请使用专业工具处理。"
-                        f = self.output.joinpath(name).resolve()
-                        if f.exists():
-                            return [], f"Already Exists: '{f}'"
-                        print(f)
+                print(f"codec: {self.codec}")
+                self.total_size = 0
+                if self.members:
+                    print(f"members: {', '.join(self.members)}")
+                    if self.index is None:
+                        print("(没有索引，将顺序读取压缩包)")
+                        return [self.output.name], ""
+                    members = select_members(self.index.members, self.members)
+                    if not members:
+                        return [], "No member matches: " + ", ".join(self.members)
+                else:
+                    assert self.index is not None
+                    members = self.index.members
+                for member in members:
+                    err = check_member(member.name, self.output)
+                    if err:
+                        return [], err
+                    self.total_size += member.size
+                    print(self.output.joinpath(member.name).resolve())
+            case Mode.Zip if self.per_item:
+                if self.zip_overwrite:
+                    print(f"Overwrite: {self.zip_overwrite}")
+                level = "default" if self.level == -1 else self.level
+                print(f"codec: {self.codec}, level: {level}, processes: {self.threads}")
+                for archive in self.archives.values():
+                    if archive.exists() and not self.zip_overwrite:
+                        return [], f"File exists: '{archive}'"
+                    print(f"Create '{archive}'")
+                return [str(x) for x in self.archives.values()], ""
             case Mode.Zip:
                 if self.output.exists() and not self.zip_overwrite:
                     return [], f"File exists: '{self.output}'"
                 if self.zip_overwrite:
                     print(f"Overwrite: {self.zip_overwrite}")
+                level = "default" if self.level == -1 else self.level
+                print(f"codec: {self.codec}, level: {level}")
+                if self.order != "name":
+                    print(f"order: {self.order}")
+                if self.incremental:
+                    self.dry_run_incremental()
                 print(f"Create '{self.output}'")
+            case Mode.Restore:
+                folder = self.snapshot_file.parent
+                for archive in self.snapshot["archives"]:
+                    if not folder.joinpath(archive).is_file():
+                        return [], f"Not Found: '{folder.joinpath(archive)}'"
+                    print(f"Restore from '{folder.joinpath(archive)}'")
+                for name in self.snapshot["files"]:
+                    err = check_name(name, self.output)
+                    if err:
+                        return [], err
+                    target = self.output.joinpath(name)
+                    verb = "overwrite " if os.path.lexists(target) else ""
+                    print(f"{verb}{target}")
         return [self.output.name], ""
 
+    def exec_per_item(self) -> None:
+        """在多个进程中同时打包，体积大的先打包 (使全部完成的时间尽量短)。"""
+        reporter = get_reporter()
+        sizes = {name: files_size(name) for name in self.names}
+        reporter.set_total(sum(sizes.values()))
+        jobs = sorted(self.names, key=lambda x: sizes[x], reverse=True)
+        with process_pool(self.threads) as pool:
+            futures = {
+                pool.submit(
+                    pack_item,
+                    name,
+                    self.archives[name],
+                    self.codec,
+                    self.level,
+                    self.block_size,
+                    self.order,
+                ): name
+                for name in jobs
+            }
+            for future in as_completed(futures):
+                future.result()
+                name = futures[future]
+                reporter.item(str(self.archives[name]), size=sizes[name])
+                reporter.add_bytes(sizes[name])
+
+    def dry_run_incremental(self) -> None:
+        """与快照比较，找出新增/修改以及已删除的文件，结果保存在 self.entries, self.changed,
+        self.deleted. 只读取文件，不修改任何文件。
+        """
+        folder = self.snapshot_file.parent
+        series = [self.snapshot_file, self.output]
+        series += [folder.joinpath(x) for x in self.snapshot["archives"]]
+        exclude = {os.path.abspath(x) for x in series}
+        self.entries = scan_entries(self.names, exclude)
+        self.changed, self.deleted = diff_entries(
+            self.snapshot["files"], self.entries, self.snapshot_hash
+        )
+        print(f"snapshot: '{self.snapshot_file}'")
+        print(f"added/changed: {len(self.changed)}, deleted: {len(self.deleted)}")
+
     def exec(self) -> Result:
         assert self.is_validated, "在执行 exec 之前必须先执行 validate"
         _, err = self.dry_run()
@@ -153,35 +506,950 @@ zip_overwrite = false  # 压缩后的文件是否覆盖同名文件
             return [], err
         match self.mode:
             case Mode.Unzip:
-                with tarfile.open(self.names[0]) as tar:
-                    
-                    import os
-                    
-                    def is_within_directory(directory, target):
-                        
-                        abs_directory = os.path.abspath(directory)
-                        abs_target = os.path.abspath(target)
-                    
-                        prefix = os.path.commonprefix([abs_directory, abs_target])
-                        
-                        return prefix == abs_directory
-                    
-                    def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                    
-                        for member in tar.getmembers():
-                            member_path = os.path.join(path, member.name)
-                            if not is_within_directory(path, member_path):
-                                raise Exception("Attempted Path Traversal in Tar File")
-                    
-                        tar.extractall(path, members, numeric_owner=numeric_owner) 
-                        
-                    
-                    safe_extract(tar, self.output)
+                reporter = get_reporter()
+                reporter.set_total(self.total_size)
+
+                def report(members):
+                    for member in members:
+                        reporter.item(member.name, size=member.size)
+                        yield member
+                        reporter.add_bytes(member.size)
+
+                if not self.members and self.writers > 1:
+                    with open_archive(self.names[0], self.codec) as tar:
+                        with ParallelExtractor(tar, self.output, self.writers) as x:
+                            for member in safe_members(tar, self.output):
+                                x.extract(member)
+                elif not self.members:
+                    with open_archive(self.names[0], self.codec) as tar:
+                        members = safe_members(tar, self.output)
+                        tar.extractall(self.output, report(members))
+                elif self.index and can_seek(self.index):
+                    targets = select_members(self.index.members, self.members)
+                    extract_at(self.names[0], self.index, targets, self.output)
+                else:
+                    known = None
+                    if self.index:
+                        targets = select_members(self.index.members, self.members)
+                        known = {x.name for x in targets}
+                    err = extract_selected(
+                        self.names[0], self.codec, self.members, known, self.output
+                    )
+                    if err:
+                        return [], err
+            case Mode.Restore:
+                for archive in self.snapshot["archives"]:
+                    restore_archive(self.snapshot_file.parent / archive, self.output)
+            case Mode.Zip if self.per_item:
+                self.exec_per_item()
+                return [str(x) for x in self.archives.values()], ""
             case Mode.Zip:
-                with tarfile.open(self.output, "w:xz") as tar:
-                    for name in self.names:
-                        tar.add(name)
+                reporter = get_reporter()
+                if self.incremental:
+                    total = sum(self.entries[x][1] for x in self.changed)
+                else:
+                    total = sum(files_size(name) for name in self.names)
+                reporter.set_total(total)
+
+                def report(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+                    reporter.item(tarinfo.name, size=tarinfo.size)
+                    reporter.add_bytes(tarinfo.size)
+                    return tarinfo
+
+                def add(tar: tarfile.TarFile, members: list[Member]) -> None:
+                    if self.incremental:
+                        changed = {x: self.entries[x] for x in self.changed}
+                        for name in sort_entries(changed, self.order):
+                            add_tree(tar, name, report, members, False)
+                        marker = dict(deleted=self.deleted)
+                        add_bytes(tar, incremental_marker, json.dumps(marker))
+                    else:
+                        add_names(tar, self.names, report, members, self.order)
+
+                threads = self.threads if self.codec == "xz" else 1
+                if threads > 1:
+                    print(f"threads: {threads}, block size: {self.block_size} MB")
+                write_archive(
+                    self.output, self.codec, self.level, threads, self.block_size, add
+                )
+                if self.incremental:
+                    # 压缩包写入成功后才更新快照
+                    self.snapshot["archives"].append(self.output.name)
+                    self.snapshot["files"] = self.entries
+                    data = json.dumps(self.snapshot, ensure_ascii=False).encode()
+                    write_atomic(self.snapshot_file, data)
         return [self.output.name], ""
 
 
 __recipe__ = TarXZ
+
+
+def zstd_module():
+    """返回可用的 zstd 模块 (Python 3.14 自带的 compression.zstd 或第三方库 zstandard)，
+    都没有则返回 None.
+    """
+    try:
+        from compression import zstd  # type: ignore
+
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard  # type: ignore
+
+        return zstandard
+    except ImportError:
+        return None
+
+
+def decompress_errors() -> tuple[type[Exception], ...]:
+    """解压缩损坏的数据时可能抛出的异常 (zstd 模块有自己的异常类)"""
+    errors: tuple[type[Exception], ...] = (
+        OSError,
+        EOFError,
+        lzma.LZMAError,
+        zlib.error,
+        ValueError,
+    )
+    zstd = zstd_module()
+    if zstd is not None and hasattr(zstd, "ZstdError"):
+        errors += (zstd.ZstdError,)
+    return errors
+
+
+def open_codec(
+    fileobj: IO[bytes],
+    codec: str,
+    mode: str,
+    level: int = -1,
+    threads: int = 1,
+    block_size: int = 16 * MB,
+) -> IO[bytes]:
+    """用 codec 压缩方法包裹 fileobj (mode 是 'rb' 或 'wb')。
+
+    返回的对象关闭时不会关闭 fileobj. codec 为 none 时直接返回 fileobj.
+    level 为 -1 时采用该压缩方法的默认级别。
+    """
+    writing = mode == "wb"
+    match codec:
+        case "xz":
+            preset = None if level == -1 else level
+            if writing and threads > 1:
+                return ParallelXZWriter(fileobj, threads, block_size, preset)
+            return lzma.LZMAFile(fileobj, mode, preset=preset if writing else None)
+        case "gz":
+            return gzip.GzipFile(
+                fileobj=fileobj, mode=mode, compresslevel=9 if level == -1 else level
+            )
+        case "bz2":
+            return bz2.BZ2File(fileobj, mode, compresslevel=9 if level == -1 else level)
+        case "zstd":
+            zstd = zstd_module()
+            assert zstd is not None, "zstd is not supported"
+            level = 3 if level == -1 else level
+            if zstd.__name__ == "zstandard":
+                if writing:
+                    return zstd.ZstdCompressor(level=level).stream_writer(
+                        fileobj, closefd=False
+                    )
+                return zstd.ZstdDecompressor().stream_reader(
+                    fileobj, read_across_frames=True, closefd=False
+                )
+            return zstd.ZstdFile(fileobj, mode, level=level if writing else None)
+        case _:
+            return fileobj
+
+
+def compress_bytes(data: bytes, codec: str, level: int) -> bytes:
+    """用于 codec = "auto" 时试压缩"""
+    buffer = io.BytesIO()
+    with open_codec(buffer, codec, "wb", level) as stream:
+        stream.write(data)
+    return buffer.getvalue() if codec != "none" else data
+
+
+def read_sample(names: list[str], size: int) -> bytes:
+    """从每个文件的开头读取一部分数据，合计不超过 size."""
+    files: list[Path] = []
+    for name in names:
+        path = Path(name)
+        if path.is_dir():
+            files.extend(x for x in sorted(path.rglob("*")) if x.is_file())
+        elif path.is_file():
+            files.append(path)
+    if not files:
+        return b""
+    per_file = max(size // len(files), 64 * 1024)
+    chunks: list[bytes] = []
+    total = 0
+    for file in files:
+        with open(file, "rb") as f:
+            chunk = f.read(min(per_file, size - total))
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            break
+    return b"".join(chunks)
+
+
+def choose_codec(names: list[str], time_budget: float) -> tuple[str, int]:
+    """用一部分数据试压缩，估算全部数据的压缩时间与体积，
+    在 time_budget 秒内 (0 表示不限) 选择压缩后体积最小的方法。
+
+    如果最好的方法也只能节省不到 3% 的体积，则不压缩 (比如照片、视频等已压缩的数据)。
+    """
+    sample = read_sample(names, auto_sample_size)
+    if not sample:
+        return "none", -1
+    total = sum(files_size(name) for name in names)
+    scale = total / len(sample)
+
+    print(f"codec: auto, sample size: {len(sample)} bytes, time budget: {time_budget}s")
+    results: list[tuple[float, float, str, int]] = []
+    for codec, level in auto_candidates:
+        if codec == "zstd" and not zstd_module():
+            continue
+        start = time.perf_counter()
+        size = len(compress_bytes(sample, codec, level))
+        seconds = (time.perf_counter() - start) * scale
+        ratio = size / len(sample)
+        print(f"  {codec}(level {level}): ratio {ratio:.3f}, ~{seconds:.1f}s")
+        results.append((size * scale, seconds, codec, level))
+
+    fits = [x for x in results if not time_budget or x[1] <= time_budget]
+    if not fits:
+        fits = [min(results, key=lambda x: x[1])]  # 都超时则选最快的
+    size, seconds, codec, level = min(fits, key=lambda x: (x[0], x[1]))
+    if size > total * 0.97:
+        codec, level = "none", -1
+    print(f"  => {codec}(level {level})")
+    return codec, level
+
+
+def detect_tar(name: str) -> str:
+    """如果 name 是一个 tar 文件 (压缩或未压缩)，则返回其压缩方法，否则返回空字符串。
+
+    根据文件开头的 magic bytes 判断压缩方法，再检查解压后的数据是否 tar 格式。
+    """
+    with open(name, "rb") as f:
+        head = f.read(8)
+    codec = "none"
+    for magic, c in codec_magic:
+        if head.startswith(magic):
+            codec = c
+    if codec == "zstd" and not zstd_module():
+        # 无法解压缩，只能根据后缀名判断。
+        return codec if name.endswith(codec_suffixes["zstd"]) else ""
+    try:
+        with open(name, "rb") as f:
+            stream = open_codec(f, codec, "rb")
+            block = stream.read(tarfile.BLOCKSIZE)
+            if stream is not f:
+                stream.close()
+    except decompress_errors():
+        return ""
+    if block[257:262] == b"ustar":
+        return codec
+    return ""
+
+
+def archive_stem(name: str) -> str:
+    """去掉压缩包的后缀名，比如 'file.tar.xz' => 'file'"""
+    for suffix in codec_suffixes.values():
+        if name.endswith(suffix):
+            return name.removesuffix(suffix)
+    return Path(name).stem
+
+
+class ThrottledTarFile(tarfile.TarFile):
+    """解压时按 disk_write 限速 (每写完一个文件按其体积等待)。"""
+
+    def makefile(self, tarinfo, targetpath):
+        super().makefile(tarinfo, targetpath)  # type: ignore
+        throttle = get_throttle("disk_write")
+        if throttle is not None:
+            throttle.wait(tarinfo.size)
+
+
+@contextmanager
+def open_archive(name: str, codec: str) -> Iterator[tarfile.TarFile]:
+    """以 stream 模式 (只能顺序读取) 打开压缩包，读取时按 disk_read 限速，
+    解压时按 disk_write 限速 (见 ThrottledTarFile)。
+    """
+    with open_throttled(name, "rb", "disk_read") as f:
+        stream = open_codec(f, codec, "rb")
+        try:
+            with ThrottledTarFile.open(name, "r|", fileobj=stream) as tar:
+                yield tar
+        finally:
+            if stream is not f:
+                stream.close()
+
+
+class Member(NamedTuple):
+    """压缩包内的一个文件。offset 是其 tar header 在解压后数据中的位置。"""
+
+    name: str
+    size: int
+    type: str
+    offset: int
+
+
+class TarIndex(NamedTuple):
+    """压缩包的文件索引。
+
+    blocks 只有多进程压缩 (threads > 1) 的 .tar.xz 才有，
+    记录每个 xz stream 的 (解压后的偏移, 压缩后的偏移, 压缩后的长度)。
+    """
+
+    codec: str
+    members: list[Member]
+    blocks: list[tuple[int, int, int]]
+
+
+def member_type(tarinfo: tarfile.TarInfo) -> str:
+    if tarinfo.isreg():
+        return "file"
+    if tarinfo.isdir():
+        return "dir"
+    if tarinfo.issym():
+        return "symlink"
+    if tarinfo.islnk():
+        return "hardlink"
+    return "other"
+
+
+def archive_key(name: str | Path) -> str:
+    """根据文件体积、修改时间以及开头与结尾的数据生成压缩包的 key,
+    文件被修改后 key 就会改变，旧的索引自然失效。
+    """
+    stat = os.stat(name)
+    h = hashlib.blake2b(f"{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=16)
+    with open(name, "rb") as f:
+        h.update(f.read(64 * 1024))
+        if stat.st_size > 128 * 1024:
+            f.seek(-64 * 1024, os.SEEK_END)
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def index_file(name: str | Path) -> Path:
+    return tar_index_dir.joinpath(archive_key(name) + ".json")
+
+
+def load_index(name: str | Path) -> TarIndex | None:
+    """读取已保存的索引，没有或格式不符时返回 None."""
+    try:
+        data = json.loads(index_file(name).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != tar_index_version:
+        return None
+    members = [Member(*x) for x in data["members"]]
+    blocks = [tuple(x) for x in data["blocks"]]
+    return TarIndex(data["codec"], members, blocks)  # type: ignore
+
+
+def save_index(name: str | Path, index: TarIndex) -> None:
+    """把索引保存到 ffe 的数据文件夹 (不会在压缩包旁边生成任何文件)。"""
+    data = dict(
+        version=tar_index_version,
+        codec=index.codec,
+        members=index.members,
+        blocks=index.blocks,
+    )
+    tar_index_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(index_file(name), json.dumps(data, ensure_ascii=False).encode())
+
+    files = sorted(tar_index_dir.glob("*.json"), key=lambda x: x.stat().st_mtime)
+    for f in files[:-tar_index_limit]:
+        f.unlink(missing_ok=True)
+
+
+def build_index(name: str, codec: str) -> TarIndex:
+    """完整读取一遍压缩包 (只读取 header, 跳过文件内容), 生成索引。"""
+    members: list[Member] = []
+    with open_archive(name, codec) as tar:
+        for tarinfo in tar:
+            members.append(
+                Member(tarinfo.name, tarinfo.size, member_type(tarinfo), tarinfo.offset)
+            )
+    return TarIndex(codec, members, [])
+
+
+def get_index(name: str, codec: str) -> TarIndex:
+    """优先使用已保存的索引，没有则生成并保存。"""
+    index = load_index(name)
+    if index is None or index.codec != codec:
+        index = build_index(name, codec)
+        save_index(name, index)
+    return index
+
+
+def normalize_member(name: str) -> str:
+    return name.strip().removeprefix("./").rstrip("/")
+
+
+def is_selected(name: str, patterns: list[str]) -> bool:
+    """name 或其上级文件夹与 patterns 中任何一项匹配 (支持通配符) 即为选中。"""
+    path = PurePosixPath(normalize_member(name))
+    candidates = [str(path), *(str(x) for x in path.parents if str(x) != ".")]
+    return any(fnmatch.fnmatchcase(x, p) for x in candidates for p in patterns)
+
+
+def has_wildcard(pattern: str) -> bool:
+    return any(c in pattern for c in "*?[")
+
+
+def select_members(members: list[Member], patterns: list[str]) -> list[Member]:
+    return [x for x in members if is_selected(x.name, patterns)]
+
+
+def check_name(name: str, output: Path) -> ErrMsg:
+    """检查压缩包内的文件名是否安全 (不会解压缩到 output 以外)。"""
+    if Path(name).is_absolute():
+        return "压缩包内含有绝对路径的文件名，请使用专业工具处理。"
+    if not is_within_directory(output, output.joinpath(name)):
+        return f"{name} 可能会解压缩到父目录，请使用专业工具处理。"
+    return ""
+
+
+def check_member(name: str, output: Path) -> ErrMsg:
+    """检查压缩包内的文件名是否安全，以及解压缩后是否会覆盖已存在的文件。"""
+    err = check_name(name, output)
+    if err:
+        return err
+    f = output.joinpath(name).resolve()
+    if f.exists():
+        return f"Already Exists: '{f}'"
+    return ""
+
+
+def can_seek(index: TarIndex) -> bool:
+    """是否可以直接定位到压缩包内的任意文件 (不需要从头开始解压)"""
+    return index.codec == "none" or bool(index.codec == "xz" and index.blocks)
+
+
+@contextmanager
+def open_archive_at(
+    name: str, index: TarIndex, offset: int
+) -> Iterator[tarfile.TarFile]:
+    """从解压后的 offset 处 (必须是某个 tar header 的位置) 开始以 stream 模式读取压缩包。
+
+    对于多块 xz, 先定位到 offset 所在的数据块，只从该块开始解压。
+    """
+    with open_throttled(name, "rb", "disk_read") as f:
+        if index.codec == "none":
+            f.seek(offset)
+            stream = f
+        else:
+            starts = [x[0] for x in index.blocks]
+            i = bisect.bisect_right(starts, offset) - 1
+            raw_offset, xz_offset, _ = index.blocks[i]
+            f.seek(xz_offset)
+            stream = open_codec(f, index.codec, "rb")
+            stream.seek(offset - raw_offset)  # 只需解压该数据块内 offset 之前的部分
+        try:
+            with ThrottledTarFile.open(name, "r|", fileobj=stream) as tar:
+                yield tar
+        finally:
+            if stream is not f:
+                stream.close()
+
+
+def extract_at(name: str, index: TarIndex, targets: list[Member], output: Path) -> None:
+    """根据索引直接定位并解压 targets, 距离较近的文件顺序读取过去，不重新定位。"""
+    reporter = get_reporter()
+    pending = deque(sorted(targets, key=lambda x: x.offset))
+    while pending:
+        base = pending[0].offset
+        with open_archive_at(name, index, base) as tar:
+            for tarinfo in tar:
+                offset = base + tarinfo.offset
+                if offset < pending[0].offset:
+                    continue
+                if offset > pending[0].offset or tarinfo.name != pending[0].name:
+                    raise Exception(f"The index does not match the archive: {name}")
+                if not is_within_directory(output, output.joinpath(tarinfo.name)):
+                    raise Exception("Attempted Path Traversal in Tar File")
+                reporter.item(tarinfo.name, size=tarinfo.size)
+                tar.extract(tarinfo, output, **extract_kwargs)  # type: ignore
+                reporter.add_bytes(tarinfo.size)
+                pending.popleft()
+                if not pending or pending[0].offset - offset > seek_gap:
+                    break
+
+
+def extract_selected(
+    name: str, codec: str, patterns: list[str], known: set[str] | None, output: Path
+) -> ErrMsg:
+    """顺序读取压缩包，只解压与 patterns 匹配的文件。
+
+    known 是已知的全部目标文件 (来自索引)，全部解压后立即停止，不读取剩余部分。
+    没有索引时，如果 patterns 都不含通配符，解压了与之同名的文件 (不是文件夹) 后也立即停止。
+    """
+    reporter = get_reporter()
+    found = False
+    literal = None
+    if known is None and not any(has_wildcard(p) for p in patterns):
+        literal = set(patterns)
+    with open_archive(name, codec) as tar:
+        for tarinfo in safe_members(tar, output):
+            member = normalize_member(tarinfo.name)
+            if not is_selected(member, patterns):
+                continue
+            err = check_member(tarinfo.name, output)
+            if err:
+                return err
+            reporter.item(tarinfo.name, size=tarinfo.size)
+            tar.extract(tarinfo, output, **extract_kwargs)  # type: ignore
+            reporter.add_bytes(tarinfo.size)
+            found = True
+            if known is not None:
+                known.discard(tarinfo.name)
+                if not known:
+                    break
+            elif literal is not None and not tarinfo.isdir():
+                literal.discard(member)
+                if not literal:
+                    break
+    if not found:
+        return "No member matches: " + ", ".join(patterns)
+    return ""
+
+
+def write_archive(
+    output: Path,
+    codec: str,
+    level: int,
+    threads: int,
+    block_size: int,
+    add: Callable[[tarfile.TarFile, list[Member]], None],
+) -> None:
+    """创建压缩包 output, 由 add 函数往其中添加文件 (并把添加的文件记录在 members 里)。
+
+    出错时删除不完整的 output.
+    """
+    members: list[Member] = []
+    try:
+        with open_throttled(output, "wb", "disk_write") as f:
+            stream = open_codec(f, codec, "wb", level, threads, block_size * MB)
+            try:
+                with tarfile.open(output, "w|", fileobj=stream) as tar:
+                    add(tar, members)
+            finally:
+                if stream is not f:
+                    stream.close()
+    except BaseException:
+        output.unlink(missing_ok=True)
+        raise
+    # 打包时顺便记录索引，以后解压缩这个文件时不需要先完整解压一遍。
+    blocks = getattr(stream, "blocks", [])
+    save_index(output, TarIndex(codec, members, blocks))
+
+
+def pack_item(
+    name: str, output: Path, codec: str, level: int, block_size: int, order: str
+) -> None:
+    """per_item 模式下在子进程中执行，把 name 打包成 output."""
+
+    def add(tar: tarfile.TarFile, members: list[Member]) -> None:
+        add_names(tar, [name], lambda x: x, members, order)
+
+    write_archive(output, codec, level, 1, block_size, add)
+
+
+def load_snapshot(file: Path) -> tuple[dict, ErrMsg]:
+    """读取增量打包的快照，文件不存在时返回一个空快照。
+
+    快照的 files 记录每个文件的 [类型, 体积, 修改时间 (纳秒), inode, 内容 hash 或 None]
+    """
+    if not file.exists():
+        return dict(version=1, archives=[], files={}), ""
+    try:
+        snapshot = json.loads(file.read_text(encoding="utf-8"))
+    except ValueError as e:
+        return {}, f"Invalid snapshot '{file}': {e}"
+    if snapshot.get("version") != 1:
+        return {}, f"Unknown snapshot version in '{file}'"
+    return snapshot, ""
+
+
+def entry_type(mode: int) -> str:
+    if stat.S_ISREG(mode):
+        return "file"
+    if stat.S_ISDIR(mode):
+        return "dir"
+    if stat.S_ISLNK(mode):
+        return "symlink"
+    return "other"
+
+
+def scan_entries(names: list[str], exclude: set[str]) -> dict[str, list]:
+    """递归列出 names 中的全部文件与文件夹 (不跟随符号链接)，exclude 是要跳过的绝对路径。"""
+    entries: dict[str, list] = {}
+
+    def add(path: str) -> None:
+        if os.path.abspath(path) in exclude:
+            return
+        st = os.lstat(path)
+        if stat.S_ISSOCK(st.st_mode):
+            return  # tar 不支持 socket
+        kind = entry_type(st.st_mode)
+        size = st.st_size if kind == "file" else 0
+        entries[path] = [kind, size, st.st_mtime_ns, st.st_ino, None]
+
+    for name in names:
+        top = os.path.normpath(name)
+        add(top)
+        if not os.path.isdir(top) or os.path.islink(top):
+            continue
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for x in sorted(dirnames + filenames):
+                add(os.path.join(dirpath, x))
+    return entries
+
+
+def file_hash(name: str) -> str:
+    h = hashlib.blake2b()
+    with open_throttled(name, "rb", "disk_read") as f:
+        while chunk := f.read(MB):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def diff_entries(
+    old: dict[str, list], new: dict[str, list], use_hash: bool
+) -> tuple[list[str], list[str]]:
+    """返回 (新增或修改的文件, 已删除的文件)。
+
+    类型、体积、修改时间与 inode 都没变的视为未修改。use_hash 为真时，
+    如果只是修改时间或 inode 变了而内容 hash 没变，也视为未修改。
+    文件夹只看是否新增 (其修改时间随内容变化，没有参考价值)。
+    """
+    changed: list[str] = []
+    for path, entry in new.items():
+        prev = old.get(path)
+        if prev and prev[0] == entry[0] == "dir":
+            continue
+        if prev and prev[:4] == entry[:4]:
+            entry[4] = prev[4]
+            if not (use_hash and entry[0] == "file" and entry[4] is None):
+                continue
+        if use_hash and entry[0] == "file":
+            entry[4] = file_hash(path)
+            if prev and prev[0] == "file" and prev[4] == entry[4]:
+                continue
+        changed.append(path)
+    deleted = sorted(set(old) - set(new), reverse=True)
+    return changed, deleted
+
+
+def physical_offset(name: str) -> int:
+    """用 FIEMAP 查询文件第一块数据在磁盘上的物理位置，不支持或没有数据时返回 -1."""
+    if fcntl is None:
+        return -1
+    # struct fiemap (32 字节) 后面跟一个 struct fiemap_extent (56 字节)
+    request = bytearray(32 + 56)
+    struct.pack_into("=QQLLLL", request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        with open(name, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return -1
+    mapped_extents = struct.unpack_from("=L", request, 20)[0]
+    if not mapped_extents:
+        return -1
+    return struct.unpack_from("=Q", request, 32 + 8)[0]  # fe_physical
+
+
+def sort_entries(entries: dict[str, list], order: str) -> list[str]:
+    """按 order 排列 scan_entries 的结果。
+
+    order 为 name 时保持原有顺序; 为 inode 或 extent 时文件夹在前 (保持原有顺序)，
+    其余按 inode 或物理位置排序 (查询不到物理位置的排在前面，再按 inode 排序)。
+    """
+    if order == "name":
+        return list(entries)
+    dirs = [x for x, entry in entries.items() if entry[0] == "dir"]
+    others = [(x, entry[3]) for x, entry in entries.items() if entry[0] != "dir"]
+    if order == "extent":
+        keys = {
+            x: (physical_offset(x) if entries[x][0] == "file" else -1, ino)
+            for x, ino in others
+        }
+    else:
+        keys = {x: (0, ino) for x, ino in others}
+    return dirs + sorted(keys, key=lambda x: keys[x])
+
+
+def add_names(
+    tar: tarfile.TarFile,
+    names: list[str],
+    report: Callable[[tarfile.TarInfo], tarfile.TarInfo],
+    members: list[Member],
+    order: str,
+) -> None:
+    """把 names (递归) 添加到压缩包，order 见 sort_entries."""
+    if order == "name":
+        for name in names:
+            add_tree(tar, name, report, members)
+        return
+    exclude = {tar.name} if tar.name else set()
+    entries = scan_entries(names, exclude)
+    for name in sort_entries(entries, order):
+        add_tree(tar, name, report, members, False)
+
+
+def add_bytes(tar: tarfile.TarFile, name: str, text: str) -> None:
+    data = text.encode()
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = int(time.time())
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def restore_archive(archive: Path, output: Path) -> None:
+    """解压一个增量压缩包 (覆盖同名文件)，然后删除其中记录的已删除文件。"""
+    reporter = get_reporter()
+    deleted: list[str] = []
+    with open_archive(str(archive), detect_tar(str(archive))) as tar:
+        for member in safe_members(tar, output):
+            if member.name == incremental_marker:
+                fileobj = tar.extractfile(member)
+                assert fileobj is not None
+                deleted = json.loads(fileobj.read())["deleted"]
+                continue
+            reporter.item(member.name, size=member.size, archive=archive.name)
+            target = output.joinpath(member.name)
+            if target.is_dir() and not target.is_symlink():
+                if not member.isdir():
+                    shutil.rmtree(target)
+            elif os.path.lexists(target):
+                target.unlink()  # 不要通过旧的符号链接写入文件
+            tar.extract(member, output, **extract_kwargs)  # type: ignore
+    for name in deleted:
+        target = output.joinpath(name)
+        # 也要检查经过符号链接后的真实位置
+        real = target.parent.resolve().joinpath(target.name)
+        inside = is_within_directory(output.resolve(), real)
+        if not inside or not is_within_directory(output, target) or target == output:
+            print(f"skip deleting '{name}': not inside {output}")
+            continue
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target, ignore_errors=True)
+        elif os.path.lexists(target):
+            target.unlink()
+
+
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    # 按路径比较 (commonprefix 按字符比较, 会把 '/out' 与 '/output' 视为包含关系)
+    try:
+        return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+    except ValueError:  # Windows 上位于不同的盘
+        return False
+
+
+def safe_members(tar: tarfile.TarFile, path) -> Iterator[tarfile.TarInfo]:
+    """逐个读取压缩包内的文件，遇到可能解压缩到 path 以外的文件则抛出异常。"""
+    for member in tar:
+        member_path = os.path.join(path, member.name)
+        if not is_within_directory(path, member_path):
+            raise Exception("Attempted Path Traversal in Tar File")
+        yield member
+
+
+def files_size(name: str) -> int:
+    """name 是文件时返回其体积，是文件夹时返回其中全部文件的体积之和。"""
+    path = Path(name)
+    if not path.is_dir():
+        return path.lstat().st_size
+    return sum(x.lstat().st_size for x in path.rglob("*") if x.is_file())
+
+
+def add_tree(
+    tar: tarfile.TarFile,
+    name: str,
+    report: Callable[[tarfile.TarInfo], tarfile.TarInfo],
+    members: list[Member],
+    recursive: bool = True,
+) -> None:
+    """与 tar.add(name, filter=report) 相同 (递归添加文件夹)，但读取文件时按 disk_read 限速。
+
+    添加的每个文件都记录在 members 里 (用于生成索引)。
+    recursive 为假时只添加文件夹本身，不添加其中的文件。
+    """
+    if tar.name is not None and os.path.abspath(name) == tar.name:
+        return  # 不要把压缩包本身添加进去
+    tarinfo = tar.gettarinfo(name)
+    if tarinfo is None:
+        return  # 不支持的文件类型，比如 socket
+    tarinfo = report(tarinfo)
+    members.append(Member(tarinfo.name, tarinfo.size, member_type(tarinfo), tar.offset))
+    if tarinfo.isreg():
+        with open_throttled(name, "rb", "disk_read") as f:
+            tar.addfile(tarinfo, f)
+    elif tarinfo.isdir():
+        tar.addfile(tarinfo)
+        if not recursive:
+            return
+        for child in sorted(os.listdir(name)):
+            add_tree(tar, os.path.join(name, child), report, members)
+    else:
+        tar.addfile(tarinfo)
+
+
+class ParallelXZWriter(io.RawIOBase):
+    """把写入的数据按 block_size 分块，在多个进程中同时压缩，再按顺序写入 fileobj.
+
+    每块数据被压缩成一个独立的 xz stream, 多个 stream 首尾相连仍是标准的 .xz 文件，
+    xz -d 以及 Python 的 lzma/tarfile 都能正常解压。
+    self.blocks 记录每块的 (解压后的偏移, 压缩后的偏移, 压缩后的长度)。
+    """
+
+    def __init__(
+        self,
+        fileobj: IO[bytes],
+        threads: int,
+        block_size: int,
+        preset: int | None = None,
+    ) -> None:
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.preset = preset
+        self.max_pending = threads * 2  # 限制同时在内存中的数据块数量
+        self.pool = process_pool(threads)
+        self.pending: deque[tuple[int, Future]] = deque()
+        self.buffer = bytearray()
+        self.blocks: list[tuple[int, int, int]] = []
+        self.raw_offset = 0
+        self.xz_offset = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def submit(self, chunk: bytes) -> None:
+        future = self.pool.submit(lzma.compress, chunk, preset=self.preset)
+        self.pending.append((len(chunk), future))
+        while len(self.pending) > self.max_pending:
+            self.write_one()
+
+    def write_one(self) -> None:
+        size, future = self.pending.popleft()
+        data = future.result()
+        self.fileobj.write(data)
+        self.blocks.append((self.raw_offset, self.xz_offset, len(data)))
+        self.raw_offset += size
+        self.xz_offset += len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.blocks and not self.pending:
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.write_one()
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            super().close()
+
+
+class ParallelExtractor:
+    """边读取压缩包边写入文件: 调用 extract 的线程 (读取线程) 负责解压缩，
+    文件内容放进有限长度的队列，由 writers 个线程同时写入磁盘并设置属性。
+
+    - 大于 inline_size 的文件由读取线程直接写入。
+    - 文件夹先创建，其属性 (权限、修改时间等) 在最后设置，
+      否则写入其中的文件会改变文件夹的修改时间。
+    - 符号链接、硬链接等在全部文件写入后再创建，避免写入文件时经过链接到达 output 以外。
+    """
+
+    def __init__(self, tar: tarfile.TarFile, output: Path, writers: int) -> None:
+        self.tar = tar
+        self.output = output
+        self.reporter = get_reporter()
+        self.pool = ThreadPoolExecutor(max_workers=writers)
+        self.slots = threading.BoundedSemaphore(writers * 4)  # 限制队列长度
+        self.errors: list[BaseException] = []
+        self.dirs: list[tuple[tarfile.TarInfo, str]] = []
+        self.deferred: list[tarfile.TarInfo] = []
+
+    def __enter__(self) -> "ParallelExtractor":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.pool.shutdown(wait=True, cancel_futures=exc_type is not None)
+        if exc_type is None:
+            self.finish()
+
+    def check_errors(self) -> None:
+        if self.errors:
+            raise self.errors[0]
+
+    def extract(self, member: tarfile.TarInfo) -> None:
+        self.check_errors()
+        tarinfo = member
+        if extract_filter is not None:
+            tarinfo = extract_filter(member, str(self.output))
+            if tarinfo is None:
+                return
+        path = os.path.join(self.output, tarinfo.name)
+        self.reporter.item(tarinfo.name, size=tarinfo.size)
+        if tarinfo.isdir():
+            os.makedirs(path, exist_ok=True)
+            self.dirs.append((tarinfo, path))
+        elif not tarinfo.isreg():
+            self.deferred.append(member)
+        elif tarinfo.size > inline_size:
+            fileobj = self.tar.extractfile(member)
+            assert fileobj is not None
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open_throttled(path, "wb", "disk_write") as f:
+                shutil.copyfileobj(fileobj, f, MB)
+            self.set_attrs(tarinfo, path)
+            self.reporter.add_bytes(tarinfo.size)
+        else:
+            fileobj = self.tar.extractfile(member)
+            assert fileobj is not None
+            data = fileobj.read()
+            self.slots.acquire()
+            future = self.pool.submit(self.write_file, tarinfo, path, data)
+            future.add_done_callback(self.done)
+
+    def write_file(self, tarinfo: tarfile.TarInfo, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open_throttled(path, "wb", "disk_write") as f:
+            f.write(data)
+        self.set_attrs(tarinfo, path)
+        self.reporter.add_bytes(tarinfo.size)
+
+    def done(self, future: Future) -> None:
+        self.slots.release()
+        if not future.cancelled() and future.exception():
+            self.errors.append(future.exception())  # type: ignore
+
+    def set_attrs(self, tarinfo: tarfile.TarInfo, path: str) -> None:
+        self.tar.chown(tarinfo, path, False)
+        self.tar.chmod(tarinfo, path)
+        self.tar.utime(tarinfo, path)
+
+    def finish(self) -> None:
+        self.check_errors()
+        for member in self.deferred:
+            self.tar.extract(member, self.output, **extract_kwargs)  # type: ignore
+        # 与 tarfile.extractall 一样，从最深的文件夹开始设置属性。
+        self.dirs.sort(key=lambda x: x[0].name, reverse=True)
+        for tarinfo, path in self.dirs:
+            self.set_attrs(tarinfo, path)
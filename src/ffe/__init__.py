@@ -1,4 +1,4 @@
 """ffe: File/Folder Extensible manipulator (可扩展的文件操作工具)"""
 
 __package_name__ = "ffe"
-__version__ = "0.1.1"
+__version__ = "0.2.0"
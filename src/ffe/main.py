@@ -5,21 +5,31 @@ import os
 from ffe.model import (
     ErrMsg,
     Recipe,
+    Reporter,
     Task,
     __recipes__,
     check_plan,
     init_recipes,
     new_plan,
+    prevalidate,
+    set_reporter,
 )
 from ffe.util import (
     Settings,
     app_config_file,
+    cached_request,
     ensure_config_file,
     ensure_recipes_folder,
+    find_recipe_url,
     get_proxies,
+    head_lines,
     peek_lines,
+    print_lines,
+    record_installed,
     request,
+    thread_map,
     tomli_load,
+    write_if_changed,
 )
 from . import (
     __version__,
@@ -206,9 +216,15 @@ def info(ctx, all, recipe_name):
 @click.option(
     "force", "-f", "--force", is_flag=True, help="Force install/update the recipe."
 )
-@click.argument("url", nargs=1)
+@click.option(
+    "update_all",
+    "--update-all",
+    is_flag=True,
+    help="Update all installed recipes whose content has changed upstream.",
+)
+@click.argument("url", nargs=1, required=False)
 @click.pass_context
-def install(ctx, peek, download, install, force, url):
+def install(ctx, peek, download, install, force, update_all, url):
     """Install recipes from an url.
 
     [URL] is a url point to a ".py" or ".toml" file.
@@ -218,27 +234,37 @@ def install(ctx, peek, download, install, force, url):
     提醒：请先下载 url 指向的文件，检查没有恶意代码后再安装，因为一旦安装，下次执行任何 ffe 命令都会自动执行其代码（自动 import）。
     """
 
+    if update_all:
+        update_all_recipes(get_proxies())
+        ctx.exit()
+
     if (not download) and (not peek) and (not install):
         click.echo('Error: Missing option "-d" or "-i"')
         click.echo('Try "ffe install --help" for help.')
         ctx.exit()
 
+    if not url:
+        click.echo('Error: Missing argument "URL"')
+        ctx.exit()
+
     proxies = get_proxies()
     file_path = Path(urlparse(url).path)
     suffix = file_path.suffix.lower()
 
     if peek:
-        resp = request(url, proxies)
         match suffix:
             case ".toml":
+                resp = request(url, proxies)
                 recipe_list = tomli.loads(resp.text).get("recipes", [])
                 if not recipe_list:
                     click.echo(f"{url} has no recipes")
                     ctx.exit()
-                for r_url in recipe_list:
-                    peek_lines(r_url, proxies)
+                # 每个插件只下载开头部分，并且同时下载。
+                all_lines = thread_map(lambda x: head_lines(x, proxies), recipe_list)
+                for r_url, lines in zip(recipe_list, all_lines):
+                    print_lines(r_url, lines)
             case _:
-                peek_lines(url, None, resp)
+                peek_lines(url, proxies)
         ctx.exit()
 
     if download:
@@ -260,33 +286,66 @@ def install(ctx, peek, download, install, force, url):
         )
         ctx.exit()
 
-    resp = request(url, proxies)
-    if suffix == ".py":
-        with open(dst, "wb") as f:
-            f.write(resp.content)
+    if suffix != ".toml":
+        install_recipe(url, dst, proxies)
+        record_installed({dst.__str__(): url})
         click.echo("OK.")
         ctx.exit()
 
     if suffix == ".toml":
+        resp = request(url, proxies)
         click.echo("Start to install a list of recipes.")
         click.echo("提醒：安装前应先审查代码，如未审查则在安装后暂时不要使用任何 ffe 命令，审查完再使用。")
         recipe_list = tomli.loads(resp.text).get("recipes", [])
         if not recipe_list:
             click.echo(f"{url} has no recipes")
             ctx.exit()
+        to_install: list[tuple[str, Path]] = []
         for r_url in recipe_list:
             filename = Path(urlparse(r_url).path).name
             dst = Path(__recipes_folder__).joinpath(filename)
             if dst.exists() and not force:
                 click.echo(f"skip {r_url}")
             else:
-                resp = request(r_url, proxies)
-                click.echo(f"install {r_url}")
-                with open(dst, "wb") as f:
-                    f.write(resp.content)
+                to_install.append((r_url, dst))
+
+        # 同时下载，所需时间约等于最慢的一个文件的下载时间。
+        def install_one(item: tuple[str, Path]) -> str:
+            r_url, dst = item
+            changed = install_recipe(r_url, dst, proxies)
+            return f"install {r_url}" if changed else f"unchanged {r_url}"
+
+        for msg in thread_map(install_one, to_install):
+            click.echo(msg)
+        record_installed({dst.__str__(): r_url for r_url, dst in to_install})
     ctx.exit()
 
 
+def install_recipe(url: str, dst: Path, proxies: dict | None) -> bool:
+    """下载 (优先采用缓存) 并安装插件，只有当内容有变化时才改写文件，有改写则返回 True."""
+    content = cached_request(url, proxies)
+    return write_if_changed(dst, content)
+
+
+def update_all_recipes(proxies: dict | None) -> None:
+    """检查全部已安装的插件，只改写内容有变化的文件。"""
+    recipes = sorted(Path(__recipes_folder__).glob("*.py"))
+
+    def update_one(file: Path) -> str:
+        url = find_recipe_url(file)
+        if not url:
+            return f"skip {file.name} (unknown url)"
+        try:
+            changed = install_recipe(url, file, proxies)
+        except Exception as e:
+            return f"Error: {file.name}: {e}"
+        return f"update {url}" if changed else f"unchanged {file.name}"
+
+    click.echo("提醒：插件更新后，请先审查代码再使用 ffe 命令。")
+    for msg in thread_map(update_one, recipes):
+        click.echo(msg)
+
+
 @cli.command(context_settings=CONTEXT_SETTINGS)
 @click.option(
     "recipe_name",
@@ -384,9 +443,15 @@ def dump(ctx, in_file, recipe_name, names):
     is_flag=True,
     help="Predict the results of a real run, based on a test run without modifying files.",
 )
+@click.option(
+    "events",
+    "--events",
+    type=click.File("w", lazy=False),
+    help='Write progress events as JSON lines to a file ("-" for stdout).',
+)
 @click.argument("names", nargs=-1, type=click.Path())
 @click.pass_context
-def run(ctx, in_file, recipe_name, is_dry, names):
+def run(ctx, in_file, recipe_name, is_dry, events, names):
     """Run tasks by specifying a file or a recipe.
 
     [NAMES] are file/folder paths(zero or many).
@@ -416,35 +481,63 @@ def run(ctx, in_file, recipe_name, is_dry, names):
 
     check(ctx, check_plan(plan))
 
+    # 指定了 --events 时以 JSON lines 的形式输出事件，否则 reporter 什么都不做。
+    reporter = Reporter(events)
+    set_reporter(reporter)
+
+    def task_failed(i: int, r: Recipe, names: list[str], err: ErrMsg) -> None:
+        reporter.error(err, task=i, recipe=r.name)
+        reporter.task_end(i, r.name, names, err)
+        reporter.plan_end(err)
+
     # 提醒：在执行以下代码之前，应先执行 check_plan 函数。
     if is_dry:
         click.echo("\n** It's a dry run, not a real run. **")
+    reporter.plan_start(len(plan["tasks"]), is_dry)
+
+    def usage_hint() -> None:
+        click.echo('Use "ffe run --help" to show usages of this command.')
+        click.echo('Use "ffe info -r <recipe>" to show details of the recipe.')
+
+    # 先并行检查全部不依赖上一个任务结果的任务。这只是提前提醒，
+    # 检查失败的任务 (可能要用到前面的任务生成的文件) 会在执行前再检查一次。
+    validated, errors = prevalidate(plan)
+    for i, err in errors:
+        recipe = plan["tasks"][i]["recipe"]
+        click.echo(f"\nWarning: task {i + 1} ({recipe}) may fail: {err}")
+    if errors:
+        click.echo("(will check these tasks again right before running them)")
 
     # 用来把上一个任务的执行结果传递到下一个任务。
     pipe_names = []
 
-    for task in plan["tasks"]:
-        r: Recipe = __recipes__[task["recipe"]]()
+    for i, task in enumerate(plan["tasks"]):
+        r: Recipe = validated.get(i) or __recipes__[task["recipe"]]()
         click.echo(f"\nrecipe: {r.name}")
 
         # 默认使用 pipe_names, 但同时还需要 pipe_names 有内容才会被使用。
         if task["options"].get("use_pipe", False) and pipe_names:
             task["names"] = pipe_names
 
-        err = r.validate(task["names"], task["options"])
-        if err:
-            click.echo(f"Error: {err}")
-            click.echo('Use "ffe run --help" to show usages of this command.')
-            click.echo('Use "ffe info -r <recipe>" to show details of the recipe.')
-            ctx.exit()
+        reporter.task_start(i, r.name, task["names"])
+        if i not in validated:
+            err = r.validate(task["names"], task["options"])
+            if err:
+                task_failed(i, r, task["names"], err)
+                click.echo(f"Error: {err}")
+                usage_hint()
+                ctx.exit()
 
         if is_dry:
             pipe_names, err = r.dry_run()
-            check(ctx, err)
         else:
             pipe_names, err = r.exec()
-            check(ctx, err)
+        if err:
+            task_failed(i, r, task["names"], err)
+        check(ctx, err)
+        reporter.task_end(i, r.name, pipe_names, "")
 
+    reporter.plan_end()
     if is_dry:
         click.echo("\nThe dry run has been completed.\n")
     else:
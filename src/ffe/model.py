@@ -1,8 +1,30 @@
+import os
 import sys
+import json
+import errno
+import time
+import mmap
+import sqlite3
+import hashlib
+import shutil
+import threading
 import importlib.util
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Type, TypedDict, cast
+from typing import IO, Any, NamedTuple, TextIO, Type, TypedDict, cast
 from abc import ABC, abstractmethod
+from ffe.util import app_data_dir, get_throttle_config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+try:
+    import xxhash
+except ImportError:  # 可选依赖，没有安装时使用 blake2b
+    xxhash = None  # type: ignore
 
 # 采用 ErrMsg 而不是采用 exception, 一来是受到 Go 语言的影响，
 # 另一方面，凡是用到 ErrMsg 的地方都是与业务逻辑密切相关并且需要向用户反馈详细错误信息的地方，
@@ -128,6 +150,23 @@ def register(recipe: Type[Recipe]):
     __recipes__[name] = recipe
 
 
+__recipe_files__: dict[str, str] = {}
+"""已加载的插件文件 (模块名 -> 文件路径)，供 process_pool 的子进程重新加载。"""
+
+
+def load_module(module_name: str, file_path: str | Path):
+    """从文件加载模块，并以 module_name 登记到 sys.modules"""
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+
+    assert spec is not None
+    assert spec.loader is not None
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 def init_recipes(folder: str) -> None:
     """注册 folder 里的全部插件。
 
@@ -136,14 +175,8 @@ def init_recipes(folder: str) -> None:
     recipes_files = Path(folder).glob("*.py")
     for file_path in recipes_files:
         module_name = file_path.stem
-        spec = importlib.util.spec_from_file_location(module_name, file_path)
-
-        assert spec is not None
-        assert spec.loader is not None
-
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module
-        spec.loader.exec_module(module)
+        module = load_module(module_name, file_path)
+        __recipe_files__[module_name] = str(file_path)
 
         if file_path.name.startswith("common_"):
             # 以 'common_' 开头的文件会被加载，但不注册为插件。
@@ -166,6 +199,45 @@ def check_plan(plan: Plan) -> ErrMsg:
     return ""
 
 
+def depends_on_pipe(i: int, task: Task) -> bool:
+    """第 i 个任务是否有可能接收上一个任务的结果 (第一个任务不可能)。"""
+    return i > 0 and task["options"].get("use_pipe", False)
+
+
+def prevalidate(plan: Plan) -> tuple[dict[int, Recipe], list[tuple[int, ErrMsg]]]:
+    """在执行任何任务之前，并行检查全部不依赖 pipe_names 的任务 (仅供参考)。
+
+    返回已通过检查、并且 names 全部存在的 recipe 实例 (key 是任务序号)，
+    执行任务时可直接使用，不必重复执行 validate; 以及检查失败的任务序号与错误信息。
+
+    后面的任务可能要用到前面的任务生成的文件，因此检查失败的任务、
+    以及 names 中有不存在的文件的任务，都应在执行前重新检查，不可据此中止计划。
+
+    提醒：在执行本函数之前，应先执行 check_plan 函数。
+    """
+    indexes = [
+        i for i, task in enumerate(plan["tasks"]) if not depends_on_pipe(i, task)
+    ]
+    if not indexes:
+        return {}, []
+
+    def validate(i: int) -> tuple[Recipe, ErrMsg, bool]:
+        task = plan["tasks"][i]
+        r: Recipe = __recipes__[task["recipe"]]()
+        all_exist = all(Path(name).exists() for name in task["names"])
+        return r, r.validate(task["names"], task["options"]), all_exist
+
+    validated: dict[int, Recipe] = {}
+    errors: list[tuple[int, ErrMsg]] = []
+    with ThreadPoolExecutor(max_workers=min(len(indexes), 8)) as pool:
+        for i, (r, err, all_exist) in zip(indexes, pool.map(validate, indexes)):
+            if err:
+                errors.append((i, err))
+            elif all_exist:
+                validated[i] = r
+    return validated, errors
+
+
 def must_exist(names: list[str] | list[Path]) -> ErrMsg:
     """names 是文件/文件夹的路径，全部存在时返回空字符串。"""
     for name in names:
@@ -238,3 +310,676 @@ def get_bool(options: dict, key: str) -> tuple[bool, ErrMsg]:
     if not isinstance(v, bool):
         return False, f"Please set {key} to 'true' or 'false'"
     return v, ""
+
+
+def init_worker(recipe_files: dict[str, str], throttle_share: int) -> None:
+    """process_pool 子进程的初始化函数。
+
+    插件是从文件加载的 (见 init_recipes), 不能通过 import 找到，因此在子进程里
+    按原来的模块名重新加载，以便子进程能找到插件里的函数。
+    另外，限速器是每个进程各自独立的，因此每个子进程只分得 1/throttle_share 的限额。
+    """
+    global __throttle_share__
+    __throttle_share__ = throttle_share
+    __throttles__.clear()
+    for module_name, file_path in recipe_files.items():
+        if module_name not in sys.modules:
+            load_module(module_name, file_path)
+
+
+def process_pool(max_workers: int) -> Executor:
+    """返回一个进程池，供插件把 CPU 密集的工作分配到多个进程。
+
+    不采用 fork (主进程里已有其他线程，fork 可能导致死锁)，而是采用 forkserver
+    (不支持时采用 spawn)，子进程由 init_worker 重新加载插件。
+    ffe-config.toml 里的 [throttle] 限速由全部子进程平分。
+    """
+    methods = multiprocessing.get_all_start_methods()
+    method = "forkserver" if "forkserver" in methods else "spawn"
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(method),
+        initializer=init_worker,
+        initargs=(dict(__recipe_files__), max_workers),
+    )
+
+
+class Reporter:
+    """以 JSON lines 的形式输出事件 (计划/任务的开始与结束、进度、错误等)。
+
+    每个事件都带有单调时间戳 t (从计划开始算起的秒数)，以及当前任务的
+    累计字节数、吞吐量 (bytes/s), 如果已知总字节数还会带有 eta (秒)。
+    未指定输出目标时 (out 为 None) 全部方法都什么也不做，因此插件可放心调用。
+    """
+
+    interval = 0.5
+    """bytes 事件的最小间隔 (秒)，避免回调过于频繁时刷屏。"""
+
+    def __init__(self, out: TextIO | None = None) -> None:
+        self.out = out
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.task_began = self.start
+        self.last_emit = 0.0
+        self.bytes_done = 0
+        self.bytes_total = 0
+
+    def emit(self, event: str, **fields) -> None:
+        if self.out is None:
+            return
+        with self.lock:
+            self._emit(event, fields)
+
+    def _emit(self, event: str, fields: dict) -> None:
+        """调用前必须先取得 self.lock"""
+        assert self.out is not None
+        now = time.monotonic()
+        elapsed = now - self.task_began
+        obj: dict[str, Any] = dict(event=event, t=round(now - self.start, 6))
+        obj.update(fields)
+        obj["bytes"] = self.bytes_done
+        obj["throughput"] = round(self.bytes_done / elapsed, 1) if elapsed > 0 else 0.0
+        if self.bytes_total:
+            obj["total"] = self.bytes_total
+            rate = obj["throughput"]
+            left = max(self.bytes_total - self.bytes_done, 0)
+            obj["eta"] = round(left / rate, 1) if rate > 0 else None
+        self.out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        self.out.flush()
+        self.last_emit = now
+
+    def plan_start(self, n_tasks: int, dry_run: bool) -> None:
+        self.start = self.task_began = time.monotonic()
+        self.emit("plan_start", tasks=n_tasks, dry_run=dry_run)
+
+    def plan_end(self, err: ErrMsg = "") -> None:
+        self.emit("plan_end", ok=not err, error=err)
+
+    def task_start(self, index: int, recipe: str, names: list[str]) -> None:
+        with self.lock:
+            self.task_began = time.monotonic()
+            self.bytes_done = 0
+            self.bytes_total = 0
+        self.emit("task_start", task=index, recipe=recipe, names=names)
+
+    def task_end(self, index: int, recipe: str, names: list[str], err: ErrMsg) -> None:
+        seconds = round(time.monotonic() - self.task_began, 6)
+        self.emit(
+            "task_end",
+            task=index,
+            recipe=recipe,
+            names=names,
+            ok=not err,
+            error=err,
+            seconds=seconds,
+        )
+
+    def set_total(self, n_bytes: int) -> None:
+        """设置当前任务预计处理的总字节数，用于计算 eta."""
+        with self.lock:
+            self.bytes_total = n_bytes
+
+    def add_bytes(self, n_bytes: int) -> None:
+        """累加已处理的字节数。可在多个线程中调用 (比如上传文件的回调函数)。"""
+        with self.lock:
+            self.bytes_done += n_bytes
+            if self.out is None:
+                return
+            finished = self.bytes_total and self.bytes_done >= self.bytes_total
+            if finished or time.monotonic() - self.last_emit >= self.interval:
+                self._emit("progress", {})
+
+    def item(self, name: str, **fields) -> None:
+        """报告单个项目 (比如一个文件) 的处理进度。"""
+        self.emit("item", name=name, **fields)
+
+    def error(self, err: ErrMsg, **fields) -> None:
+        self.emit("error", error=err, **fields)
+
+
+__reporter__ = Reporter()
+
+
+def get_reporter() -> Reporter:
+    """插件通过这个函数获取当前的 Reporter, 用来报告进度。"""
+    return __reporter__
+
+
+def set_reporter(reporter: Reporter) -> None:
+    global __reporter__
+    __reporter__ = reporter
+
+
+class TokenBucket:
+    """令牌桶限速器。rate 是每秒补充的令牌数，burst 是桶的容量。
+
+    允许一次取走超过 burst 的令牌 (欠账)，此时会按比例等待更长时间。
+    可在多个线程中使用。
+    """
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst else rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+throttle_kinds = ("net_up", "net_down", "disk_read", "disk_write")
+"""限速类别：网络上传/下载、硬盘读/写。"""
+
+
+class Throttle:
+    """一个类别的限速器，包括带宽 (bytes/s) 与每秒操作次数 (iops)。"""
+
+    def __init__(self, bandwidth: float, iops: float) -> None:
+        self.bytes = TokenBucket(bandwidth) if bandwidth > 0 else None
+        self.ops = TokenBucket(iops) if iops > 0 else None
+
+    def wait(self, n_bytes: int) -> None:
+        """每次读/写之后调用，n_bytes 是本次读/写的字节数。"""
+        if self.ops:
+            self.ops.consume(1)
+        if self.bytes and n_bytes > 0:
+            self.bytes.consume(n_bytes)
+
+
+__throttles__: dict[str, Throttle | None] = {}
+
+__throttle_share__ = 1
+"""本进程分得 1/__throttle_share__ 的限额 (process_pool 的子进程见 init_worker)"""
+
+
+def get_throttle(kind: str) -> Throttle | None:
+    """根据 ffe-config.toml 里的 [throttle] 设置获取限速器，未设置限速则返回 None.
+
+    [throttle] 里的 net_up, net_down, disk_read, disk_write 的单位是 MB/s,
+    另外可设置 disk_read_iops, disk_write_iops 等 (每秒读/写次数)，0 表示不限。
+    同一个进程内全部插件共用同一个限速器; process_pool 的子进程平分限额。
+    """
+    assert kind in throttle_kinds, f"unknown throttle kind: {kind}"
+    if kind not in __throttles__:
+        cfg = get_throttle_config()
+        bandwidth = cfg.get(kind, 0) * MB / __throttle_share__
+        iops = cfg.get(f"{kind}_iops", 0) / __throttle_share__
+        throttle = None
+        if bandwidth > 0 or iops > 0:
+            throttle = Throttle(bandwidth, iops)
+        __throttles__[kind] = throttle
+    return __throttles__[kind]
+
+
+class ThrottledFile:
+    """包裹一个二进制文件对象，读/写时按限速器等待。其他方法直接转交给原对象。"""
+
+    chunk_size = 256 * 1024
+    """一次读取全部内容时，按这个大小分块读取，使等待时间分布得更平均。"""
+
+    def __init__(self, fileobj: IO[bytes], throttle: Throttle) -> None:
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size: int | None = -1) -> bytes:
+        if size is None or size < 0:
+            chunks = []
+            while chunk := self.read(self.chunk_size):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        data = self.fileobj.read(size)
+        self.throttle.wait(len(data))
+        return data
+
+    def readinto(self, buffer) -> int:
+        n = self.fileobj.readinto(buffer)  # type: ignore
+        self.throttle.wait(n or 0)
+        return n
+
+    def write(self, data) -> int:
+        n = self.fileobj.write(data)
+        self.throttle.wait(len(data))
+        return n
+
+    def __getattr__(self, name: str):
+        return getattr(self.fileobj, name)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.fileobj.close()
+
+
+def throttled(fileobj: IO[bytes], kind: str) -> IO[bytes]:
+    """如果 kind 类别设置了限速，则用 ThrottledFile 包裹 fileobj, 否则原样返回。"""
+    throttle = get_throttle(kind)
+    if throttle is None:
+        return fileobj
+    return cast(IO[bytes], ThrottledFile(fileobj, throttle))
+
+
+def open_throttled(file: str | Path, mode: str, kind: str) -> IO[bytes]:
+    """以二进制模式打开文件，并按 kind 类别限速。"""
+    assert "b" in mode, "open_throttled only supports binary mode"
+    return throttled(cast(IO[bytes], open(file, mode)), kind)
+
+
+def is_throttled(*kinds: str) -> bool:
+    return any(get_throttle(kind) is not None for kind in kinds)
+
+
+def throttled_copyfile(src: str | Path, dst: str | Path) -> None:
+    """复制文件内容，读写分别按 disk_read, disk_write 限速。"""
+    with open_throttled(src, "rb", "disk_read") as fsrc, open_throttled(
+        dst, "wb", "disk_write"
+    ) as fdst:
+        shutil.copyfileobj(fsrc, fdst, MB)
+
+
+FICLONE = 0x40049409
+"""Linux 的 ioctl, 在支持写时复制的文件系统 (Btrfs, XFS 等) 上让两个文件共享数据块 (reflink)"""
+
+copy_workers = 8
+"""copy_files 同时复制的文件数量上限"""
+
+kernel_copy_errors = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ENOTSOCK,
+)
+"""copy_file_range / sendfile 不支持当前文件 (或文件系统) 时的错误码"""
+
+
+def copy_data(fsrc: IO[bytes], fdst: IO[bytes]) -> None:
+    """把 fsrc 的全部内容复制到 (空的) fdst, 依次尝试:
+
+    1. FICLONE (reflink, 不复制数据)
+    2. os.copy_file_range / os.sendfile (在内核中复制，不经过用户空间)
+    3. 以 1 MB 为单位读写
+
+    复制的字节数少于源头文件的大小时抛出 OSError.
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    size = os.fstat(infd).st_size
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(outfd, FICLONE, infd)
+            return
+        except OSError:
+            pass  # 不支持 reflink 或跨文件系统
+
+    calls = []
+    if hasattr(os, "copy_file_range"):
+        calls.append(lambda pos: os.copy_file_range(infd, outfd, 64 * MB, pos, pos))
+    if hasattr(os, "sendfile"):
+        calls.append(lambda pos: os.sendfile(outfd, infd, pos, 64 * MB))
+    for call in calls:
+        copied = 0
+        try:
+            while n := call(copied):
+                copied += n
+        except OSError as e:
+            # 只有在一个字节都没复制时才可以换另一种方法
+            if copied or e.errno not in kernel_copy_errors:
+                raise
+        if copied:
+            break
+    else:
+        # 一个字节都没复制 (不支持，或像某些 FUSE/procfs 文件那样直接返回 0)
+        shutil.copyfileobj(fsrc, fdst, MB)
+        copied = fdst.tell()
+    if copied < size:
+        raise OSError(errno.EIO, f"Short copy: {copied} of {size} bytes")
+
+
+verify_hashes = ("blake2b", "sha256")
+"""复制文件时可以同时计算的 hash 算法"""
+
+
+def file_digest(file: str | Path, hash_name: str) -> str:
+    """计算文件的 hash (按 disk_read 限速)，返回 16 进制字符串。"""
+    h = hashlib.new(hash_name)
+    with open_throttled(file, "rb", "disk_read") as f:
+        while chunk := f.read(MB):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_and_hash(src: str | Path, dst: str | Path, hash_name: str) -> str:
+    """复制文件内容的同时计算 hash (只读取源头文件一次)，返回 16 进制字符串。"""
+    h = hashlib.new(hash_name)
+    with open_throttled(src, "rb", "disk_read") as fsrc:
+        with open_throttled(dst, "wb", "disk_write") as fdst:
+            while chunk := fsrc.read(MB):
+                h.update(chunk)
+                fdst.write(chunk)
+    return h.hexdigest()
+
+
+def copy_file(
+    src: str | Path, dst: str | Path, hash_name: str = "", verify_dst: bool = False
+) -> str:
+    """复制文件内容与属性 (权限、修改时间等)。
+
+    先复制到 dst 所在文件夹的临时文件，完成后再 os.replace 为 dst,
+    因此 dst 要么是旧文件要么是完整的新文件，不会出现复制到一半的文件。
+    如果在 ffe-config.toml 里设置了 [throttle] disk_read/disk_write, 则按设置限速
+    (此时只能在用户空间读写)。
+
+    如果指定了 hash_name (见 verify_hashes)，则在复制的同时计算 hash 并返回，
+    verify_dst 为真时还会重新读取复制后的文件进行核对，不一致则抛出 OSError.
+    """
+    dst = Path(dst)
+    temp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    digest = ""
+    try:
+        if hash_name:
+            digest = copy_and_hash(src, temp, hash_name)
+            if verify_dst and file_digest(temp, hash_name) != digest:
+                raise OSError(errno.EIO, f"Checksum mismatch after copying to '{dst}'")
+        elif is_throttled("disk_read", "disk_write"):
+            throttled_copyfile(src, temp)
+        else:
+            with open(src, "rb") as fsrc, open(temp, "wb") as fdst:
+                copy_data(fsrc, fdst)
+        shutil.copystat(src, temp)
+        os.replace(temp, dst)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    return digest
+
+
+def move_file(
+    src: str | Path, dst: str | Path, hash_name: str = "", verify_dst: bool = False
+) -> str:
+    """移动文件: 同一文件系统内直接改名，否则用 copy_file 复制后删除源头文件
+    (复制并核对成功后才删除源头文件，两者大小不一致时不删除并抛出 OSError)。
+
+    如果指定了 hash_name, 则返回文件的 hash (直接改名时需要读取一次文件来计算)。
+    """
+    try:
+        os.replace(src, dst)
+        return file_digest(dst, hash_name) if hash_name else ""
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    digest = copy_file(src, dst, hash_name, verify_dst)
+    if os.stat(src).st_size != os.stat(dst).st_size:
+        raise OSError(errno.EIO, f"Size mismatch after copying '{src}' to '{dst}'")
+    os.unlink(src)
+    return digest
+
+
+def copy_files(
+    pairs: list[tuple[Path, Path]],
+    move: bool = False,
+    hash_name: str = "",
+    verify_dst: bool = False,
+    max_workers: int = copy_workers,
+) -> tuple[dict[Path, str], list[ErrMsg]]:
+    """同时复制 (或移动) 多个文件，pairs 是 (src, dst) 列表。
+
+    返回 {dst: hash} (未指定 hash_name 时 hash 为空字符串) 以及全部错误信息，
+    个别文件出错不影响其他文件。hash_name, verify_dst 见 copy_file.
+    """
+    if not pairs:
+        return {}, []
+
+    def copy_one(pair: tuple[Path, Path]) -> tuple[str, ErrMsg]:
+        src, dst = pair
+        try:
+            if move:
+                return move_file(src, dst, hash_name, verify_dst), ""
+            return copy_file(src, dst, hash_name, verify_dst), ""
+        except OSError as e:
+            return "", f"{src}: {e}"
+
+    digests: dict[Path, str] = {}
+    errors: list[ErrMsg] = []
+    with ThreadPoolExecutor(max_workers=min(len(pairs), max_workers)) as pool:
+        for (_, dst), (digest, err) in zip(pairs, pool.map(copy_one, pairs)):
+            if err:
+                errors.append(err)
+            else:
+                digests[dst] = digest
+    return digests, errors
+
+
+hash_cache_file = app_data_dir.joinpath("hash-cache.sqlite")
+"""文件内容 hash 的缓存，供全部插件共用"""
+
+hash_workers = 8
+"""hash_files 同时计算 hash 的文件数量上限"""
+
+hash_chunk_size = 4 * MB
+"""分块 hash 的块大小"""
+
+small_file_size = MB
+"""小于此体积的文件直接读取 (不用 mmap), 并且在当前线程中计算 (不值得交给线程池)"""
+
+racy_window_ns = 2 * 10**9
+"""修改时间距离开始计算 hash 不足此时长的文件不写入缓存 (参考 git 的 "racily clean"):
+同一时间精度内 (FAT/exFAT, SMB 为 2 秒) 再次修改而体积不变的文件，修改时间可能不变。
+"""
+
+
+def default_hash_algo() -> str:
+    """安装了 xxhash 时使用 xxh3_128 (非常快), 否则使用 blake2b."""
+    return "xxh3_128" if xxhash is not None else "blake2b"
+
+
+def new_hash(algo: str, data: bytes | memoryview = b""):
+    if algo.startswith("xxh"):
+        if xxhash is None:
+            raise ValueError(f"{algo} requires the xxhash package")
+        return getattr(xxhash, algo)(data)
+    return hashlib.new(algo, data)
+
+
+class FileHash(NamedTuple):
+    digest: str
+    """整个文件的 hash (16 进制)"""
+
+    chunks: list[str]
+    """每 hash_chunk_size 一块的 hash (16 进制), 未要求分块时为空列表"""
+
+
+class HashCache:
+    """以 SQLite 保存文件内容的 hash, 避免重复读取没有变化的文件。
+
+    以 (dev, ino, algo) 为主键，只有 size 与 mtime_ns 也相同时才算命中，
+    因此文件被修改后旧记录自然失效，并在重新计算后被覆盖。
+    可在多个线程中使用; 不可跨进程共用同一个实例 (各进程请分别创建)。
+    """
+
+    def __init__(self, file: Path = hash_cache_file) -> None:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dev INTEGER, ino INTEGER, algo TEXT, size INTEGER, mtime_ns INTEGER, "
+            "digest TEXT, chunks BLOB, PRIMARY KEY (dev, ino, algo)) WITHOUT ROWID"
+        )
+
+    def __enter__(self) -> "HashCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def get(self, info: os.stat_result, algo: str) -> tuple[str, bytes | None] | None:
+        """返回 (digest, chunks), 未命中时返回 None. chunks 是各块 hash 直接相连的 bytes."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, chunks FROM hashes "
+                "WHERE dev=? AND ino=? AND algo=? AND size=? AND mtime_ns=?",
+                (info.st_dev, info.st_ino, algo, info.st_size, info.st_mtime_ns),
+            ).fetchone()
+        return row
+
+    def put_many(
+        self, rows: list[tuple[os.stat_result, str, str, bytes | None]]
+    ) -> None:
+        """rows 是 (stat, algo, digest, chunks) 列表，在同一个事务中写入。"""
+        params = [
+            (x.st_dev, x.st_ino, algo, x.st_size, x.st_mtime_ns, digest, chunks)
+            for x, algo, digest, chunks in rows
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", params
+            )
+
+
+def hash_file(file: str | Path, algo: str, chunks: bool = False) -> tuple[str, bytes]:
+    """计算文件的 hash, 返回 (16 进制 digest, 各块 hash 相连的 bytes).
+
+    大文件用 mmap 读取 (hashlib 计算时会释放 GIL, 因此多个线程可同时计算),
+    如果设置了 disk_read 限速则改为按限速读取。
+    """
+    h = new_hash(algo)
+    blocks: list[bytes] = []
+    if is_throttled("disk_read"):
+        with open_throttled(file, "rb", "disk_read") as f:
+            while chunk := f.read(hash_chunk_size):
+                h.update(chunk)
+                if chunks:
+                    blocks.append(new_hash(algo, chunk).digest())
+        return h.hexdigest(), b"".join(blocks)
+
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < small_file_size:
+            data = f.read()
+            h.update(data)
+            if chunks and data:
+                blocks.append(new_hash(algo, data).digest())
+            return h.hexdigest(), b"".join(blocks)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(m) as view:
+                for pos in range(0, size, hash_chunk_size):
+                    with view[pos : pos + hash_chunk_size] as chunk:
+                        h.update(chunk)
+                        if chunks:
+                            blocks.append(new_hash(algo, chunk).digest())
+    return h.hexdigest(), b"".join(blocks)
+
+
+def split_chunks(chunks: bytes, digest_size: int) -> list[str]:
+    return [
+        chunks[i : i + digest_size].hex() for i in range(0, len(chunks), digest_size)
+    ]
+
+
+def hash_files(
+    files: list[str] | list[Path],
+    algo: str = "",
+    chunks: bool = False,
+    cache: HashCache | None = None,
+    max_workers: int = hash_workers,
+) -> tuple[dict[str, FileHash], list[ErrMsg]]:
+    """计算多个文件的 hash, 优先使用 HashCache, 未命中的文件在线程池中计算并写入缓存。
+
+    返回 {str(file): FileHash} 以及全部错误信息，个别文件出错不影响其他文件。
+    algo 默认使用 default_hash_algo(), chunks 为真时同时返回分块 hash.
+    未指定 cache 时临时打开默认的缓存文件; 缓存不可用时直接计算，不报错。
+    """
+    algo = algo or default_hash_algo()
+    if cache is not None:
+        return hash_with_cache(files, algo, chunks, cache, max_workers)
+    try:
+        cache = HashCache()
+    except (sqlite3.Error, OSError):
+        return hash_with_cache(files, algo, chunks, None, max_workers)
+    with cache:
+        return hash_with_cache(files, algo, chunks, cache, max_workers)
+
+
+def hash_with_cache(
+    files: list[str] | list[Path],
+    algo: str,
+    chunks: bool,
+    cache: HashCache | None,
+    max_workers: int,
+) -> tuple[dict[str, FileHash], list[ErrMsg]]:
+    """hash_files 的具体实现，cache 为 None 表示不使用缓存。"""
+    digest_size = new_hash(algo).digest_size
+    results: dict[str, FileHash] = {}
+    errors: list[ErrMsg] = []
+    misses: list[tuple[str, os.stat_result]] = []
+    for file in files:
+        name = str(file)
+        try:
+            info = os.stat(name)
+            row = cache.get(info, algo) if cache else None
+        except OSError as e:
+            errors.append(str(e))
+            continue
+        except sqlite3.Error:
+            row, cache = None, None
+        if row and (not chunks or row[1] is not None):
+            results[name] = FileHash(row[0], split_chunks(row[1] or b"", digest_size))
+        else:
+            misses.append((name, info))
+    if not misses:
+        return results, errors
+
+    def hash_one(name: str) -> tuple[str, bytes, os.stat_result | None, ErrMsg]:
+        try:
+            digest, blocks = hash_file(name, algo, chunks)
+            return digest, blocks, os.stat(name), ""
+        except OSError as e:
+            return "", b"", None, str(e)
+
+    started = time.time_ns()
+    large = [x for x in misses if x[1].st_size >= small_file_size]
+    hashed = [(x, hash_one(x[0])) for x in misses if x[1].st_size < small_file_size]
+    if large:
+        with ThreadPoolExecutor(max_workers=min(len(large), max_workers)) as pool:
+            hashed.extend(zip(large, pool.map(hash_one, [x[0] for x in large])))
+
+    rows = []
+    for (name, before), (digest, blocks, after, err) in hashed:
+        if err:
+            errors.append(err)
+            continue
+        results[name] = FileHash(digest, split_chunks(blocks, digest_size))
+        # 计算期间文件有变化，或者修改时间太接近，都不写入缓存
+        racy = started - before.st_mtime_ns < racy_window_ns
+        changed = after is None or (after.st_size, after.st_mtime_ns) != (
+            before.st_size,
+            before.st_mtime_ns,
+        )
+        if not racy and not changed:
+            rows.append((before, algo, digest, blocks if chunks else None))
+    if cache and rows:
+        try:
+            cache.put_many(rows)
+        except sqlite3.Error:
+            pass  # 缓存只是为了加速，写入失败不影响结果
+    return results, errors
@@ -1,11 +1,21 @@
+import os
+import re
+import json
+import hashlib
+import threading
 from pathlib import Path
-from typing import TypedDict, cast
+from typing import TYPE_CHECKING, TypedDict, cast
+from concurrent.futures import ThreadPoolExecutor
 from appdirs import AppDirs
+from requests.adapters import HTTPAdapter
 from requests.models import Response
 import toml
 import tomli
 import requests
 
+if TYPE_CHECKING:
+    from ffe.model import Throttle
+
 
 class Settings(TypedDict):
     recipes_folder: str
@@ -16,7 +26,11 @@ class Settings(TypedDict):
 app_dirs = AppDirs("ffe", "github-ahui2016")
 app_config_dir = Path(app_dirs.user_config_dir)
 app_config_file = app_config_dir.joinpath("ffe-config.toml")
-default_recipes_dir = Path(app_dirs.user_data_dir).joinpath("recipes").__str__()
+app_data_dir = Path(app_dirs.user_data_dir)
+default_recipes_dir = app_data_dir.joinpath("recipes").__str__()
+http_cache_dir = app_data_dir.joinpath("http-cache")
+installed_recipes_file = app_data_dir.joinpath("installed-recipes.json")
+"""记录每个已安装插件的下载地址，用于 ffe install --update-all"""
 default_settings = Settings(
     recipes_folder=default_recipes_dir, http_proxy="", use_proxy=True
 )
@@ -54,6 +68,15 @@ def get_config() -> Settings:
     return settings
 
 
+def get_throttle_config() -> dict:
+    """读取 ffe-config.toml 里的 [throttle] 设置，没有设置则返回空字典。"""
+    try:
+        config = tomli_load(app_config_file.__str__())
+    except FileNotFoundError:
+        return {}
+    return config.get("throttle", {})
+
+
 def get_proxies() -> dict | None:
     settings = get_config()
     proxies = None
@@ -65,22 +88,232 @@ def get_proxies() -> dict | None:
     return proxies
 
 
+max_downloads = 8
+"""同时下载的文件数量上限 (也是连接池的大小)"""
+
+__session__: requests.Session | None = None
+__session_lock__ = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """全部网络请求共用同一个 Session, 以便复用连接 (keep-alive), 避免每次都重新握手。
+
+    如果用户设置了代理则采用代理。
+    """
+    global __session__
+    with __session_lock__:
+        if __session__ is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=max_downloads, pool_maxsize=max_downloads
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks["response"].append(throttle_download)
+            proxies = get_proxies()
+            if proxies:
+                session.proxies.update(proxies)
+            __session__ = session
+        return __session__
+
+
+class ThrottledStream:
+    """包裹 urllib3 的响应 (resp.raw), 下载时按限速器等待。其他方法直接转交给原对象。"""
+
+    def __init__(self, raw, throttle: "Throttle") -> None:
+        self.raw = raw
+        self.throttle = throttle
+
+    def stream(self, amt: int = 2**16, decode_content: bool | None = None):
+        for chunk in self.raw.stream(amt, decode_content=decode_content):
+            self.throttle.wait(len(chunk))
+            yield chunk
+
+    def read(self, *args, **kwargs) -> bytes:
+        data = self.raw.read(*args, **kwargs)
+        self.throttle.wait(len(data))
+        return data
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
+
+
+def throttle_download(resp: Response, *args, **kwargs) -> Response:
+    """Session 的 response hook: 如果在 ffe-config.toml 里设置了 [throttle] net_down,
+    则读取 resp 的内容时按设置限速 (包括 resp.content 与 stream 模式)。
+    """
+    from ffe.model import get_throttle  # model 依赖 util, 因此不能在文件开头 import
+
+    throttle = get_throttle("net_down")
+    if throttle is not None:
+        resp.raw = ThrottledStream(resp.raw, throttle)
+    return resp
+
+
 def request(url: str, proxies: dict | None) -> requests.Response:
     """下载文件，如果用户设置了代理则采用代理"""
-    resp = requests.get(url, proxies=proxies)
+    resp = get_session().get(url, proxies=proxies)
     resp.raise_for_status()
     return resp
 
 
-def peek_lines(url: str, proxies: dict = None, resp: Response = None) -> None:
-    print(url)
-    if not resp:
-        resp = request(url, proxies)
-    n, max = 0, 5
+def thread_map(fn, items: list) -> list:
+    """同时执行 (最多 max_downloads 个线程，用于同时下载多个文件)，按 items 的顺序返回结果。"""
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(items), max_downloads)) as pool:
+        return list(pool.map(fn, items))
+
+
+def write_atomic(file: Path, content: bytes) -> None:
+    """先写入临时文件再改名，避免中途出错时留下不完整的文件。"""
+    temp = file.with_name(f"{file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp, "wb") as f:
+        f.write(content)
+    os.replace(temp, file)
+
+
+def write_if_changed(file: Path, content: bytes) -> bool:
+    """只有当文件内容有变化时才写入 (避免无谓地改变文件的修改时间)，有写入则返回 True."""
+    if file.exists() and file.read_bytes() == content:
+        return False
+    write_atomic(file, content)
+    return True
+
+
+def cached_request(url: str, proxies: dict | None) -> bytes:
+    """下载文件并缓存在 ffe 的数据文件夹里。
+
+    如果缓存里已有该文件，则带上 If-None-Match / If-Modified-Since 向服务器确认，
+    服务器返回 304 (Not Modified) 时直接采用缓存，不需要重新下载。
+    """
+    http_cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()
+    meta_file = http_cache_dir.joinpath(key + ".json")
+    body_file = http_cache_dir.joinpath(key + ".body")
+
+    headers = {}
+    if meta_file.exists() and body_file.exists():
+        meta = json.loads(meta_file.read_text())
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    resp = get_session().get(url, proxies=proxies, headers=headers)
+    if resp.status_code == 304:
+        return body_file.read_bytes()
+    resp.raise_for_status()
+
+    meta = dict(
+        url=url,
+        etag=resp.headers.get("ETag", ""),
+        last_modified=resp.headers.get("Last-Modified", ""),
+    )
+    write_atomic(body_file, resp.content)
+    write_atomic(meta_file, json.dumps(meta).encode())
+    return resp.content
+
+
+def get_installed_recipes() -> dict[str, str]:
+    """返回已记录的插件 {文件路径: 下载地址}"""
+    if not installed_recipes_file.exists():
+        return {}
+    return json.loads(installed_recipes_file.read_text())
+
+
+def record_installed(recipes: dict[str, str]) -> None:
+    """记录插件的下载地址，recipes 的格式是 {文件路径: 下载地址}"""
+    installed = get_installed_recipes()
+    installed.update(recipes)
+    app_data_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(installed_recipes_file, json.dumps(installed, indent=2).encode())
+
+
+def find_recipe_url(file: Path) -> str:
+    """找出插件的下载地址。
+
+    优先采用安装时记录的地址，如果没有记录 (比如旧版 ffe 安装的插件)，
+    则从插件开头的简介中寻找以该文件名结尾的网址。
+    """
+    url = get_installed_recipes().get(file.__str__(), "")
+    if url:
+        return url
+    pattern = re.compile(r"https?://\S+/" + re.escape(file.name) + r"\b")
+    with open(file, encoding="utf-8", errors="replace") as f:
+        for _, line in zip(range(30), f):
+            if m := pattern.search(line):
+                return m.group()
+    return ""
+
+
+peek_max_lines = 5
+"""peek 时每个文件显示多少行"""
+
+peek_size = 4096
+"""peek 时先尝试只下载文件开头的这么多字节 (HTTP Range)"""
+
+
+def take_lines(resp: Response, max_lines: int) -> list[bytes]:
+    lines = []
     for line in resp.iter_lines():
-        if n >= max:
+        if len(lines) >= max_lines:
             break
-        n += 1
+        lines.append(line)
+    return lines
+
+
+def head_lines(
+    url: str, proxies: dict | None, max_lines: int = peek_max_lines
+) -> list[str]:
+    """只下载文件的开头部分，返回前 max_lines 行。
+
+    先用 HTTP Range 只请求前 peek_size 个字节，如果服务器不支持 Range 则采用 stream 模式，
+    读够行数后立即关闭连接，不会下载整个文件。
+    """
+    session = get_session()
+    headers = {"Range": f"bytes=0-{peek_size - 1}"}
+    with session.get(url, proxies=proxies, headers=headers, stream=True) as resp:
+        if resp.status_code == 416:  # Range Not Satisfiable, 即空文件。
+            return []
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            # 服务器忽略了 Range, 此时 stream 模式也能确保只读取需要的部分。
+            lines = take_lines(resp, max_lines)
+            return [line.decode(errors="replace") for line in lines]
+
+        body = resp.content
+        total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+        if total.isdigit():
+            truncated = int(total) > len(body)
+        else:
+            # 没有 Content-Range (或总长度未知), 只能根据收到的长度判断。
+            truncated = len(body) >= peek_size
+        lines = body.splitlines()
+        if truncated:
+            lines = lines[:-1]  # 最后一行有可能被截断了
+
+    if len(lines) < max_lines and truncated:
+        # 开头几行比 peek_size 更长，只好读取更多内容。
+        with session.get(url, proxies=proxies, stream=True) as resp:
+            resp.raise_for_status()
+            lines = take_lines(resp, max_lines)
+    return [line.decode(errors="replace") for line in lines[:max_lines]]
+
+
+def print_lines(url: str, lines: list[str]) -> None:
+    print(url)
+    for line in lines:
         if line:
-            print(line.decode())  # Default encoding is 'utf-8'.
+            print(line)
     print()
+
+
+def peek_lines(url: str, proxies: dict = None, resp: Response = None) -> None:
+    """打印文件的前几行。如果已经下载了 resp 就直接使用，否则只下载文件的开头部分。"""
+    if resp:
+        lines = take_lines(resp, peek_max_lines)
+        lines = [line.decode(errors="replace") for line in lines]
+    else:
+        lines = head_lines(url, proxies)
+    print_lines(url, lines)